@@ -0,0 +1,169 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import shutil
+import tempfile
+from utils import peak_rss_mb, read_json, write_json
+
+# Times every pipeline stage against reproducible synthetic histories. Each scale gets its own working
+# directory (the scripts use relative data/ paths) and every stage runs in a fresh child process, so peak
+# RSS is that stage's own high-water mark. A scale is run as one discarded warm-up pass plus --runs timed
+# passes, and each stage keeps its best. Results go to a JSON file and can be checked against a baseline
+# recorded on the same Python version, machine type and CPU count.
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SCRIPTS_DIR)
+BENCH_DIR = os.path.join(REPO_DIR, 'benchmarks')
+RESULTS_PATH = os.path.join(BENCH_DIR, 'results.json')
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+START = '2024-01-01'
+SEED = 42
+
+# name -> (days, rows drawn per day). The generator keeps at most one row per key (market, account, brand,
+# rep), 800 per day, so drawing more per day only repeats keys and never reaches the later stages; volume
+# is scaled by days instead. Every stage reports the rows actually stored.
+SCALES = {
+    'tiny': (1, 800),
+    'small': (90, 800),
+    'medium': (365, 800),
+    'large': (3 * 365, 800),
+    'xlarge': (10 * 365, 800),
+}
+DEFAULT_SCALES = ['tiny', 'small', 'medium', 'large']
+# Each entry runs in its own child process; 'streamlit' reports both the initial load and a filter rerun.
+CHILD_STAGES = ['generate', 'process_data', 'build_dashboard', 'generate_weekly_recap', 'streamlit']
+
+def history_rows():
+    import raw_store
+    return raw_store.total_rows()
+
+def child(stage, days, rows_per_day):
+    # Runs one stage in this (fresh) process and prints its measurements as JSON.
+    sys.path.insert(0, SCRIPTS_DIR)
+    sys.argv = [stage]
+    if stage == 'generate':
+        import generate_fake_data
+        t0 = time.perf_counter()
+        generate_fake_data.main(['--days', str(days), '--start', START, '--rows-per-day', str(rows_per_day), '--seed', str(SEED)])
+        records = [('generate', time.perf_counter() - t0, history_rows())]
+    elif stage == 'process_data':
+        import process_data
+        t0 = time.perf_counter()
+        process_data.main(['--full'])
+        records = [(stage, time.perf_counter() - t0, history_rows())]
+    elif stage in ('build_dashboard', 'generate_weekly_recap'):
+        module = __import__(stage)
+        t0 = time.perf_counter()
+        module.main()
+        records = [(stage, time.perf_counter() - t0, history_rows())]
+    else:
+        from streamlit.testing.v1 import AppTest
+        rows = history_rows()
+        t0 = time.perf_counter()
+        app = AppTest.from_file(os.path.join(REPO_DIR, 'streamlit_app.py'), default_timeout=600).run()
+        load = time.perf_counter() - t0
+        if app.exception:
+            raise SystemExit(f'streamlit app failed: {app.exception[0].value}')
+        t0 = time.perf_counter()
+        app.sidebar.selectbox[0].select_index(0).run()
+        app.sidebar.multiselect[0].set_value(app.sidebar.multiselect[0].options[:2]).run()
+        app.sidebar.multiselect[1].set_value(app.sidebar.multiselect[1].options[:1]).run()
+        records = [('streamlit_load', load, rows), ('streamlit_filter', (time.perf_counter() - t0) / 3, rows)]
+    print(json.dumps([{'stage': s, 'seconds': t, 'rows': int(n), 'peak_rss_mb': peak_rss_mb()} for s, t, n in records]))
+
+def run_child(stage, days, rows_per_day, workdir):
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', stage, str(days), str(rows_per_day)], cwd=workdir, capture_output=True, text=True)
+    if proc.returncode != 0:
+        raise SystemExit(f'{stage} failed in {workdir}:\n{proc.stderr}')
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def bench_scale(name, workdir, runs):
+    days, rows_per_day = SCALES[name]
+    workdir = os.path.join(workdir, name)
+    results = {}
+    for i in range(runs + 1):
+        # Every pass starts from an empty tree so it measures the same work; pass 0 is the warm-up.
+        shutil.rmtree(workdir, ignore_errors=True)
+        os.makedirs(workdir)
+        for stage in CHILD_STAGES:
+            for rec in run_child(stage, days, rows_per_day, workdir):
+                if i:
+                    # Best time and lowest peak RSS over the timed passes.
+                    best = results.setdefault(rec['stage'], rec)
+                    peak = min(best['peak_rss_mb'], rec['peak_rss_mb'])
+                    if rec['seconds'] < best['seconds']:
+                        results[rec['stage']] = best = rec
+                    best['peak_rss_mb'] = peak
+    for rec in results.values():
+        rec['rows_per_sec'] = rec['rows'] / rec['seconds'] if rec['seconds'] > 0 else None
+        print(f"  {name:<7} {rec['stage']:<22} {rec['seconds']:8.3f}s {rec['rows']:>11,} rows {rec['rows_per_sec'] or 0:>13,.0f} rows/s {rec['peak_rss_mb']:8.1f} MB")
+    return {'days': days, 'rows_per_day': rows_per_day, 'runs': runs, 'stages': results}
+
+def environment(results):
+    return {k: results.get(k) for k in ('python', 'machine', 'cpus')}
+
+def compare(results, baseline, tolerance, min_seconds):
+    # A stage regresses when it is slower (beyond a small absolute noise floor) or uses more peak memory
+    # than the baseline by more than the tolerance.
+    failures = []
+    for scale, res in results['scales'].items():
+        base = baseline.get('scales', {}).get(scale)
+        if base is None or (base['days'], base['rows_per_day']) != (res['days'], res['rows_per_day']):
+            continue
+        for stage, rec in res['stages'].items():
+            old = base['stages'].get(stage)
+            if old is None:
+                continue
+            if rec['seconds'] > old['seconds'] * (1 + tolerance) + min_seconds:
+                failures.append(f"{scale}/{stage}: {rec['seconds']:.3f}s vs baseline {old['seconds']:.3f}s")
+            if rec['peak_rss_mb'] > old['peak_rss_mb'] * (1 + tolerance):
+                failures.append(f"{scale}/{stage}: {rec['peak_rss_mb']:.1f} MB vs baseline {old['peak_rss_mb']:.1f} MB")
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark every pipeline stage on synthetic histories of several sizes.')
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=DEFAULT_SCALES, help='Scales to run (days x rows/day: ' + ', '.join(f'{k}={d}x{r}' for k, (d, r) in SCALES.items()) + ').')
+    parser.add_argument('--workdir', default=os.path.join(tempfile.gettempdir(), 'cpws-bench'), help='Scratch directory for the generated histories.')
+    parser.add_argument('--results', default=RESULTS_PATH, help='Where to write the results JSON.')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='Baseline results to compare against.')
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline instead of comparing.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown / memory growth before failing.')
+    parser.add_argument('--min-seconds', type=float, default=0.05, help='Absolute slack added to time comparisons to absorb noise on tiny stages.')
+    parser.add_argument('--runs', type=int, default=3, help='Timed passes per scale after the warm-up pass; each stage keeps its best time.')
+    args = parser.parse_args(argv)
+
+    results = {'started': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(), 'machine': platform.machine(), 'cpus': os.cpu_count(), 'scales': {}}
+    for name in args.scales:
+        print(f'{name}: {SCALES[name][0]} day(s) x {SCALES[name][1]:,} rows/day')
+        results['scales'][name] = bench_scale(name, args.workdir, max(1, args.runs))
+    write_json(args.results, results)
+    print('Wrote', args.results)
+
+    if args.save_baseline:
+        write_json(args.baseline, results)
+        print('Saved baseline', args.baseline)
+        return
+    if not os.path.exists(args.baseline):
+        print('No baseline to compare against; run with --save-baseline to create one.')
+        return
+    baseline = read_json(args.baseline)
+    if environment(baseline) != environment(results):
+        # Timings and memory from another interpreter or machine are not comparable.
+        print(f'Baseline was recorded on {environment(baseline)}, this run on {environment(results)}; not comparing. Run with --save-baseline to record one here.')
+        return
+    failures = compare(results, baseline, args.tolerance, args.min_seconds)
+    if failures:
+        print(f'PERFORMANCE REGRESSION ({len(failures)} stage(s) beyond {args.tolerance:.0%} of baseline):')
+        for line in failures:
+            print('  ' + line)
+        raise SystemExit(1)
+    print('No regressions against baseline.')
+
+if __name__ == '__main__':
+    if len(sys.argv) == 5 and sys.argv[1] == '--child':
+        child(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        main()
@@ -1,42 +1,311 @@
 
 import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pandas as pd
+import plotly
 import plotly.express as px
 from plotly.io import to_html
-from utils import PROCESSED_DIR, OUTPUTS_DIR, DOCS_DIR
-
-processed_path = os.path.join(PROCESSED_DIR, 'processed.csv')
-if not os.path.exists(processed_path):
-    raise SystemExit('Processed data not found. Run process_data.py first.')
-
-df = pd.read_csv(processed_path, parse_dates=['date'])
-territory_summary = pd.read_csv(os.path.join(OUTPUTS_DIR, 'territory_summary.csv'))
-account_summary = pd.read_csv(os.path.join(OUTPUTS_DIR, 'account_summary.csv'))
-
-last_update = pd.Timestamp(df['date'].max()).strftime('%Y-%m-%d')
-latest_week = territory_summary['week'].max()
-latest_year = territory_summary[territory_summary['week']==latest_week]['year'].max()
-latest_terr = territory_summary[(territory_summary['year']==latest_year) & (territory_summary['week']==latest_week)]
-
-bar = px.bar(latest_terr.sort_values('pct_attained', ascending=False), x='market', y='pct_attained', text='pct_attained', title=f'Territory % Attained - Week {latest_week} ({latest_year})')
-bar.update_traces(texttemplate='%{text:.0%}', textposition='outside')
-bar.update_yaxes(tickformat='.0%')
-trend = df.groupby(['date','market'])['sales_volume'].sum().reset_index()
-line = px.line(trend, x='date', y='sales_volume', color='market', title='Daily Sales Volume Trend by Market')
-acc = account_summary[(account_summary['year']==latest_year) & (account_summary['week']==latest_week)].copy()
-acc['disp_per_1k_goal'] = (acc['displays'] / acc['goal'].replace(0,1)) * 1000
-heat = px.density_heatmap(acc, x='account', y='market', z='disp_per_1k_goal', color_continuous_scale='Blues', title='Display Intensity (per 1,000 Goal) - Latest Week')
-
-cards_html = f'''<div style="display:flex; gap:16px; flex-wrap:wrap; margin-bottom:20px;">
+import tables
+import periods
+import features
+from periods import PERIOD
+from utils import DATA_DIR, DOCS_DIR, file_checksum, step
+
+PROCESSED_COLUMNS = ['date','market','account','sales_volume']
+OUTPUT_PATH = os.path.join(DOCS_DIR, 'index.html')
+
+# The trend chart is the only figure whose size grows with history. It is reduced to at most MAX_POINTS points
+# in total before plotting: by resampling to weekly then monthly totals, or with LTTB on the daily series.
+MAX_POINTS = 2000
+DOWNSAMPLE_METHODS = ['resample', 'lttb']
+PERIODS = [('W', 'Weekly'), ('M', 'Monthly')]
+
+# The published site is a static shell plus data/manifest.json, data/trend.json and one small JSON shard per
+# period (ISO week) under data/weeks/. The page fetches the manifest and trend once and a shard per selected week;
+# shards are rewritten only when their content changes. --inline builds the old single self-contained page.
+SITE_DATA_DIR = os.path.join(DOCS_DIR, 'data')
+WEEKS_DIR = os.path.join(SITE_DATA_DIR, 'weeks')
+MANIFEST_PATH = os.path.join(SITE_DATA_DIR, 'manifest.json')
+TREND_PATH = os.path.join(SITE_DATA_DIR, 'trend.json')
+TERRITORY_FIELDS = ['market','goal','sales','displays','voids','pct_attained']
+ACCOUNT_FIELDS = ['market','account','goal','displays']
+# Per-market sums of the precomputed trend features, for the WoW and 4-week cards.
+FEATURE_FIELDS = ['market','wow_change','sales_4w','goal_4w']
+# --inline keeps each figure's serialized HTML fragment under FIGURE_CACHE_DIR, keyed by a hash of the exact frame
+# it is drawn from, its spec, plotly's version and this script. Only figures whose key changed are rebuilt.
+FIGURE_CACHE_DIR = os.path.join(DATA_DIR, 'figure_cache')
+CODE_HASH = file_checksum(__file__)
+CARD = '<div style="flex:1; min-width:220px; background:#f6f8fa; padding:16px; border-radius:8px;"><div style="font-size:12px; color:#555;">{label}</div><div id="{id}" style="font-size:22px; font-weight:700;">{value}</div></div>'
+
+def load_inputs():
+    if not tables.exists(tables.PROCESSED):
+        raise SystemExit('Processed data not found. Run process_data.py first.')
+    df = tables.read_table(tables.PROCESSED, columns=PROCESSED_COLUMNS)
+    territory_summary = tables.read_table(tables.output('territory_summary'), aggregated=True)
+    account_summary = tables.read_table(tables.output('account_summary'), aggregated=True)
+    feats = tables.read_table(tables.output(features.NAME), columns=[PERIOD] + FEATURE_FIELDS, aggregated=True)
+    return df, territory_summary, account_summary, feats
+
+def lttb(x, y, n):
+    # Largest-Triangle-Three-Buckets: returns the positions of n points that keep the visual shape of (x, y).
+    size = len(x)
+    if n >= size or n < 3:
+        return np.arange(size)
+    edges = np.linspace(1, size - 1, n - 1).astype(int)
+    keep = np.empty(n, dtype=int)
+    keep[0], keep[-1] = 0, size - 1
+    for i in range(n - 2):
+        lo, hi = edges[i], edges[i + 1]
+        nlo, nhi = hi, edges[i + 2] if i + 2 < len(edges) else size
+        ax, ay = x[keep[i]], y[keep[i]]
+        cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        area = np.abs((ax - cx) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (cy - ay))
+        keep[i + 1] = lo + int(area.argmax())
+    return keep
+
+def lttb_series(trend, per_series):
+    parts = []
+    for _, g in trend.groupby('market', observed=True, sort=False):
+        x = g['date'].to_numpy().astype('int64').astype(float)
+        parts.append(g.iloc[lttb(x, g['sales_volume'].to_numpy(dtype=float), per_series)])
+    return pd.concat(parts).sort_values(['date','market'], kind='mergesort', ignore_index=True)
+
+def reduce_trend(trend, max_points=MAX_POINTS, method='resample'):
+    # Returns the trend with at most ~max_points points and the label of its granularity.
+    per_series = max(max_points // max(trend['market'].nunique(), 1), 3)
+    if trend.groupby('market', observed=True).size().max() <= per_series:
+        return trend, 'Daily'
+    if method == 'lttb':
+        return lttb_series(trend, per_series), 'Daily'
+    for freq, label in PERIODS:
+        resampled = trend.assign(date=trend['date'].dt.to_period(freq).dt.start_time)
+        out = resampled.groupby(['date','market'], observed=True)['sales_volume'].sum().reset_index()
+        if out.groupby('market', observed=True).size().max() <= per_series:
+            return out, label
+    return lttb_series(out, per_series), label
+
+SHELL = '''<!DOCTYPE html><html><head><meta charset="utf-8" /><meta name="viewport" content="width=device-width, initial-scale=1" /><title>CPWS Roll-Up Dashboard (Simulated)</title>
+<script src="https://cdn.plot.ly/plotly-2.35.2.min.js" charset="utf-8"></script>
+<style>body { font-family: -apple-system, Segoe UI, Roboto, Inter, Arial; margin: 32px; } select { font-size: 14px; padding: 4px; }</style></head><body>
+<h1>CPWS Roll-Up Dashboard (Simulated)</h1><p>This dashboard auto-updates via GitHub Actions. Data are simulated for demonstration only.</p>
+<p><label for="week">ISO Week </label><select id="week"></select></p>
+<div style="display:flex; gap:16px; flex-wrap:wrap; margin-bottom:20px;">
+''' + '\n'.join(CARD.format(label=label, id=id, value='&mdash;') for label, id in [('Last Update', 'last-update'), ('Markets Tracked', 'markets'), ('Accounts', 'accounts'), ('Total Displays (Selected Week)', 'displays'), ('WoW Sales Change (Selected Week)', 'wow'), ('4-Week % Attained', 'att-4w')]) + '''
+</div>
+<div class="section" id="bar"></div><div class="section" id="line"></div><div class="section" id="heat"></div>
+<p style="margin-top:40px; color:#666; font-size:12px;">© 2026 Jesse Flippen · Simulated data.</p>
+<script>
+const shards = new Map();
+let manifest;
+async function getJSON(path) {
+  const res = await fetch('data/' + path);
+  if (!res.ok) throw new Error(path + ': ' + res.status);
+  return res.json();
+}
+function shard(file) {
+  if (!shards.has(file)) shards.set(file, getJSON(file));
+  return shards.get(file);
+}
+async function showWeek(i) {
+  const d = await shard(manifest.weeks[i].file);
+  const t = d.territory, a = d.account, label = `Week ${d.week} (${d.year})`;
+  const order = t.market.map((_, j) => j).sort((x, y) => t.pct_attained[y] - t.pct_attained[x]);
+  Plotly.react('bar', [{type: 'bar', x: order.map(j => t.market[j]), y: order.map(j => t.pct_attained[j]), text: order.map(j => t.pct_attained[j]), texttemplate: '%{text:.0%}', textposition: 'outside'}],
+    {title: `Territory % Attained - ${label}`, yaxis: {tickformat: '.0%', title: 'pct_attained'}, xaxis: {title: 'market'}});
+  Plotly.react('heat', [{type: 'histogram2d', histfunc: 'sum', x: a.account, y: a.market, z: a.displays.map((v, j) => v / (a.goal[j] || 1) * 1000), colorscale: 'Blues'}],
+    {title: `Display Intensity (per 1,000 Goal) - ${label}`, xaxis: {title: 'account'}, yaxis: {title: 'market'}});
+  document.getElementById('displays').textContent = t.displays.reduce((x, y) => x + y, 0);
+  const f = d.features, sum = xs => xs.reduce((x, y) => x + y, 0), goal4w = sum(f.goal_4w);
+  document.getElementById('wow').textContent = sum(f.wow_change).toLocaleString('en-US', {signDisplay: 'always'});
+  document.getElementById('att-4w').textContent = goal4w ? Math.round(sum(f.sales_4w) / goal4w * 100) + '%' : '\u2014';
+}
+async function init() {
+  manifest = await getJSON('manifest.json');
+  document.getElementById('last-update').textContent = manifest.last_update;
+  document.getElementById('markets').textContent = manifest.markets;
+  document.getElementById('accounts').textContent = manifest.accounts;
+  const select = document.getElementById('week');
+  manifest.weeks.forEach((w, i) => select.add(new Option(w.label, i)));
+  select.value = manifest.weeks.length - 1;
+  select.onchange = () => showWeek(Number(select.value));
+  await showWeek(manifest.weeks.length - 1);
+  const trend = await getJSON(manifest.trend);
+  Plotly.newPlot('line', Object.entries(trend.series).map(([name, s]) => ({type: 'scatter', mode: 'lines', name, x: s.date, y: s.sales_volume})),
+    {title: `${trend.granularity} Sales Volume Trend by Market`, xaxis: {title: 'date'}, yaxis: {title: 'sales_volume'}});
+}
+init();
+</script></body></html>
+'''
+
+def columns(df, fields):
+    # Column-oriented JSON: one array per field keeps shards small.
+    out = {}
+    for col in fields:
+        values = df[col]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(str)
+        elif values.dtype.kind == 'f':
+            values = values.round(4)
+        out[col] = values.tolist()
+    return out
+
+def write_if_changed(path, text):
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            if f.read() == text:
+                return False
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp, path)
+    return True
+
+def dump(payload):
+    return json.dumps(payload, separators=(',', ':'))
+
+def build(df, territory_summary, account_summary, feats, max_points=MAX_POINTS, method='resample', inline=False, workers=1):
+    if inline:
+        return build_inline(df, territory_summary, account_summary, max_points, method, workers)
+    os.makedirs(WEEKS_DIR, exist_ok=True)
+    with step('dashboard.shards') as s:
+        weeks, written = [], 0
+        for key in periods.unique(territory_summary[PERIOD]):
+            year, week = periods.split(key)
+            file = f'weeks/{periods.label(key)}.json'
+            terr, acc = periods.rows(territory_summary, key), periods.rows(account_summary, key)
+            feat = periods.rows(feats, key).groupby('market', observed=True)[FEATURE_FIELDS[1:]].sum().reset_index()
+            payload = {PERIOD: int(key), 'year': year, 'week': week, 'territory': columns(terr, TERRITORY_FIELDS), 'account': columns(acc, ACCOUNT_FIELDS), 'features': columns(feat, FEATURE_FIELDS)}
+            path = os.path.join(SITE_DATA_DIR, file)
+            if write_if_changed(path, dump(payload)):
+                written += 1
+                s.wrote(path)
+            weeks.append({PERIOD: int(key), 'label': periods.label(key), 'file': file})
+        current = {os.path.basename(w['file']) for w in weeks}
+        for name in os.listdir(WEEKS_DIR):
+            if name not in current:
+                os.remove(os.path.join(WEEKS_DIR, name))
+        s.rows_in, s.rows_out = len(territory_summary) + len(account_summary), len(weeks)
+        s.fields['shards_written'] = written
+
+    with step('dashboard.trend') as s:
+        trend = df.groupby(['date','market'], observed=True)['sales_volume'].sum().reset_index()
+        trend, granularity = reduce_trend(trend, max_points, method)
+        series = {str(m): {'date': g['date'].dt.strftime('%Y-%m-%d').tolist(), 'sales_volume': g['sales_volume'].tolist()} for m, g in trend.groupby('market', observed=True)}
+        if write_if_changed(TREND_PATH, dump({'granularity': granularity, 'series': series})):
+            s.wrote(TREND_PATH)
+        s.rows_in, s.rows_out = len(df), len(trend)
+
+    manifest = {'last_update': pd.Timestamp(df['date'].max()).strftime('%Y-%m-%d'), 'markets': int(df['market'].nunique()), 'accounts': int(df['account'].nunique()), 'trend': 'trend.json', 'weeks': weeks}
+    write_if_changed(MANIFEST_PATH, dump(manifest))
+    write_if_changed(OUTPUT_PATH, SHELL)
+    return OUTPUT_PATH
+
+def bar_figure(terr, title):
+    bar = px.bar(terr.sort_values('pct_attained', ascending=False), x='market', y='pct_attained', text='pct_attained', title=title)
+    bar.update_traces(texttemplate='%{text:.0%}', textposition='outside')
+    bar.update_yaxes(tickformat='.0%')
+    return bar
+
+def line_figure(trend, title):
+    return px.line(trend, x='date', y='sales_volume', color='market', title=title)
+
+def heat_figure(acc, title):
+    acc = acc.copy()
+    acc['disp_per_1k_goal'] = (acc['displays'] / acc['goal'].replace(0,1)) * 1000
+    return px.density_heatmap(acc, x='account', y='market', z='disp_per_1k_goal', color_continuous_scale='Blues', title=title)
+
+FIGURES = {'bar': bar_figure, 'line': line_figure, 'heat': heat_figure}
+
+def figure_key(name, frame, spec):
+    h = hashlib.sha256(json.dumps([CODE_HASH, plotly.__version__, name, spec, list(frame.columns), [str(t) for t in frame.dtypes]]).encode())
+    h.update(pd.util.hash_pandas_object(frame, index=False).to_numpy().tobytes())
+    return h.hexdigest()[:32]
+
+def render_figure(name, frame, spec):
+    # include_plotlyjs is part of the spec: the first figure on the page carries the plotly.js script tag.
+    spec = dict(spec)
+    include = spec.pop('include_plotlyjs', False)
+    return to_html(FIGURES[name](frame, **spec), full_html=False, include_plotlyjs=include)
+
+def figure_fragments(figures, workers=1):
+    # figures maps name -> (frame, spec). Cached fragments are reused; the rest are rendered, across a process
+    # pool when more than one changed, and replace that figure's previous cache entry.
+    os.makedirs(FIGURE_CACHE_DIR, exist_ok=True)
+    with step('dashboard.figures') as s:
+        fragments, jobs = {}, []
+        for name, (frame, spec) in figures.items():
+            path = os.path.join(FIGURE_CACHE_DIR, f'{name}-{figure_key(name, frame, spec)}.html')
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    fragments[name] = f.read()
+                s.read(path)
+            else:
+                jobs.append((name, frame, spec, path))
+        if workers > 1 and len(jobs) > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+                rendered = list(pool.map(render_figure, *zip(*[job[:3] for job in jobs])))
+        else:
+            rendered = [render_figure(*job[:3]) for job in jobs]
+        for (name, _, _, path), html in zip(jobs, rendered):
+            for old in os.listdir(FIGURE_CACHE_DIR):
+                if old.startswith(name + '-'):
+                    os.remove(os.path.join(FIGURE_CACHE_DIR, old))
+            write_if_changed(path, html)
+            s.wrote(path)
+            fragments[name] = html
+        s.rows_out = len(jobs)
+        s.fields['cached'] = len(figures) - len(jobs)
+    return fragments
+
+def build_inline(df, territory_summary, account_summary, max_points=MAX_POINTS, method='resample', workers=1):
+    with step('dashboard.slices') as s:
+        last_update = pd.Timestamp(df['date'].max()).strftime('%Y-%m-%d')
+        latest = periods.latest(territory_summary[PERIOD])[0]
+        latest_year, latest_week = periods.split(latest)
+        latest_terr = periods.rows(territory_summary, latest)
+        trend = df.groupby(['date','market'], observed=True)['sales_volume'].sum().reset_index()
+        trend, granularity = reduce_trend(trend, max_points, method)
+        acc = periods.rows(account_summary, latest)
+        s.rows_in, s.rows_out = len(df), len(trend)
+        s.fields['trend'] = granularity
+
+    fragments = figure_fragments({
+        'bar': (latest_terr, {'title': f'Territory % Attained - Week {latest_week} ({latest_year})', 'include_plotlyjs': 'cdn'}),
+        'line': (trend, {'title': f'{granularity} Sales Volume Trend by Market'}),
+        'heat': (acc, {'title': 'Display Intensity (per 1,000 Goal) - Latest Week'}),
+    }, workers)
+
+    with step('dashboard.serialize') as s:
+        cards_html = f'''<div style="display:flex; gap:16px; flex-wrap:wrap; margin-bottom:20px;">
 <div style="flex:1; min-width:220px; background:#f6f8fa; padding:16px; border-radius:8px;"><div style="font-size:12px; color:#555;">Last Update</div><div style="font-size:22px; font-weight:700;">{last_update}</div></div>
 <div style="flex:1; min-width:220px; background:#f6f8fa; padding:16px; border-radius:8px;"><div style="font-size:12px; color:#555;">Markets Tracked</div><div style="font-size:22px; font-weight:700;">{df['market'].nunique()}</div></div>
 <div style="flex:1; min-width:220px; background:#f6f8fa; padding:16px; border-radius:8px;"><div style="font-size:12px; color:#555;">Accounts</div><div style="font-size:22px; font-weight:700;">{df['account'].nunique()}</div></div>
 <div style="flex:1; min-width:220px; background:#f6f8fa; padding:16px; border-radius:8px;"><div style="font-size:12px; color:#555;">Total Displays (Latest Week)</div><div style="font-size:22px; font-weight:700;">{int(latest_terr['displays'].sum())}</div></div>
 </div>'''
 
-html = f'''<!DOCTYPE html><html><head><meta charset="utf-8" /><meta name="viewport" content="width=device-width, initial-scale=1" /><title>CPWS Roll-Up Dashboard (Simulated)</title><style>body {{ font-family: -apple-system, Segoe UI, Roboto, Inter, Arial; margin: 32px; }}</style></head><body><h1>CPWS Roll-Up Dashboard (Simulated)</h1><p>This dashboard auto-updates via GitHub Actions. Data are simulated for demonstration only.</p>{cards_html}<div class="section">{to_html(bar, full_html=False, include_plotlyjs='cdn')}</div><div class="section">{to_html(line, full_html=False, include_plotlyjs=False)}</div><div class="section">{to_html(heat, full_html=False, include_plotlyjs=False)}</div><p style="margin-top:40px; color:#666; font-size:12px;">© 2026 Jesse Flippen · Simulated data.</p></body></html>'''
+        html = f'''<!DOCTYPE html><html><head><meta charset="utf-8" /><meta name="viewport" content="width=device-width, initial-scale=1" /><title>CPWS Roll-Up Dashboard (Simulated)</title><style>body {{ font-family: -apple-system, Segoe UI, Roboto, Inter, Arial; margin: 32px; }}</style></head><body><h1>CPWS Roll-Up Dashboard (Simulated)</h1><p>This dashboard auto-updates via GitHub Actions. Data are simulated for demonstration only.</p>{cards_html}<div class="section">{fragments['bar']}</div><div class="section">{fragments['line']}</div><div class="section">{fragments['heat']}</div><p style="margin-top:40px; color:#666; font-size:12px;">© 2026 Jesse Flippen · Simulated data.</p></body></html>'''
+        s.fields['html_bytes'] = len(html.encode('utf-8'))
+
+    os.makedirs(DOCS_DIR, exist_ok=True)
+    with step('dashboard.write') as s:
+        if write_if_changed(OUTPUT_PATH, html):
+            s.wrote(OUTPUT_PATH)
+    return OUTPUT_PATH
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Build the static dashboard page.')
+    parser.add_argument('--max-points', type=int, default=MAX_POINTS, help='Upper bound on points in the trend chart, across all markets.')
+    parser.add_argument('--downsample', choices=DOWNSAMPLE_METHODS, default='resample', help='Reduce long trends by resampling to weekly/monthly totals or with LTTB on the daily series.')
+    parser.add_argument('--inline', action='store_true', help='Write a single self-contained page for the latest week instead of the sharded site.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='With --inline, render changed figures across a process pool of this size.')
+    args = parser.parse_args(argv)
+    with step('build_dashboard'):
+        build(*load_inputs(), max_points=args.max_points, method=args.downsample, inline=args.inline, workers=args.workers)
+    print('Wrote docs/index.html')
 
-os.makedirs(DOCS_DIR, exist_ok=True)
-with open(os.path.join(DOCS_DIR, 'index.html'), 'w', encoding='utf-8') as f:
-    f.write(html)
-print('Wrote docs/index.html')
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import os
+import re
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+import raw_store
+from utils import RAW_DIR, ensure_dirs, file_checksum, step, store_lock
+
+# Compaction and retention for the raw side. Daily store partitions of closed months (the newest stored date
+# is more than --grace-days past the month's end) are merged into one zstd Parquet partition per month. The
+# daily files are checked against their manifest checksums before merging, the monthly file is read back and
+# its row count and content checksum per day compared with the daily files, and only then does the manifest
+# switch over and the daily files get deleted. Each date keeps its version in the manifest, so processing
+# sees nothing to rebuild. Retention deletes daily_YYYY-MM-DD.csv drops older than --keep-days once their
+# day is in the store, and with --drop-legacy the already imported raw_history.csv.
+DROP_PATTERN = re.compile(r'daily_(\d{4}-\d{2}-\d{2})\.csv$')
+
+def content_checksums(df):
+    # Per date: row count and a checksum of the rows in stored order, independent of the file they live in.
+    hashed = pd.util.hash_pandas_object(df.assign(date=df['date'].astype('datetime64[ns]')), index=False).to_numpy()
+    return {pd.Timestamp(d).strftime('%Y-%m-%d'): (len(rows), hashlib.sha256(hashed[rows].tobytes()).hexdigest()) for d, rows in df.groupby('date').indices.items()}
+
+def closed_months(manifest, grace_days):
+    # month partition name -> its daily partitions, in date order, for every closed month.
+    parts = manifest['partitions']
+    newest = max(entry['dates'][-1] for entry in parts.values())
+    cutoff = pd.Timestamp(newest) - pd.Timedelta(days=grace_days)
+    months = {}
+    for name, entry in raw_store.partitions(manifest):
+        if raw_store.is_monthly(name):
+            continue
+        month_end = pd.Timestamp(entry['dates'][0]) + pd.offsets.MonthEnd(0)
+        if month_end <= cutoff:
+            months.setdefault(raw_store.month_name(entry['dates'][0]), []).append((name, entry))
+    return months
+
+def compact_month(name, sources):
+    # Writes and verifies one monthly partition; returns its manifest entry. Nothing is deleted here.
+    for source, entry in sources:
+        if file_checksum(raw_store.partition_path(entry)) != entry['sha256']:
+            raise SystemExit(f'{source}: file does not match its manifest checksum; not compacting {name}.')
+    df = pd.concat([raw_store.read_partition(entry) for _, entry in sources], ignore_index=True)
+    expected = content_checksums(df)
+    entry = raw_store.write_partition(name, df)
+    versions = raw_store.date_versions({'partitions': dict(sources)})
+    entry['days'] = {d: versions[d] for d in entry['dates']}
+    path = raw_store.partition_path(entry)
+    written = content_checksums(raw_store.read_partition(entry))
+    if written != expected or entry['rows'] != sum(e['rows'] for _, e in sources) or file_checksum(path) != entry['sha256']:
+        os.remove(path)
+        raise SystemExit(f'{name}: merged partition does not match its daily files; daily files kept.')
+    return entry
+
+def remap_key_index(index, moves):
+    # moves: daily partition day -> (monthly partition day, row offset within the month).
+    days = np.array(sorted(moves))
+    month_days = np.array([moves[d][0] for d in days])
+    offsets = np.array([moves[d][1] for d in days])
+    mask = np.isin(index['day'], days)
+    at = np.searchsorted(days, index['day'][mask])
+    index['row'][mask] += offsets[at]
+    index['day'][mask] = month_days[at]
+    return index
+
+def compact(manifest, grace_days, dry_run=False):
+    months = closed_months(manifest, grace_days)
+    if dry_run or not months:
+        return {name: [source for source, _ in sources] for name, sources in months.items()}
+    with step('compact', months=len(months)) as s:
+        index = raw_store.load_key_index(manifest)
+        parts, moves, merged = manifest['partitions'], {}, {}
+        for name, sources in sorted(months.items()):
+            s.read(*[raw_store.partition_path(e) for _, e in sources])
+            entry = compact_month(name, sources)
+            s.wrote(raw_store.partition_path(entry))
+            offset = 0
+            for source, e in sources:
+                moves[raw_store.partition_day(source)] = (raw_store.partition_day(name), offset)
+                offset += e['rows']
+            merged[name] = (entry, sources)
+        # The key index is removed first, so a crash before the new one is saved leaves it to be rebuilt
+        # rather than pointing into partitions the manifest no longer has.
+        if os.path.exists(raw_store.KEY_INDEX_PATH):
+            os.remove(raw_store.KEY_INDEX_PATH)
+        for name, (entry, sources) in merged.items():
+            for source, _ in sources:
+                del parts[source]
+            parts[name] = entry
+        raw_store.save_manifest(manifest)
+        raw_store.save_key_index(remap_key_index(index, moves), manifest)
+        for entry, sources in merged.values():
+            for _, e in sources:
+                os.remove(raw_store.partition_path(e))
+        s.rows_in = s.rows_out = sum(e['rows'] for e, _ in merged.values())
+        s.fields['partitions_removed'] = len(moves)
+    return {name: [source for source, _ in sources] for name, (_, sources) in merged.items()}
+
+def expired_drops(manifest, keep_days):
+    versions = raw_store.date_versions(manifest)
+    cutoff = (pd.Timestamp(max(versions)) - pd.Timedelta(days=keep_days)).strftime('%Y-%m-%d')
+    drops = []
+    for entry in os.scandir(RAW_DIR):
+        m = DROP_PATTERN.match(entry.name)
+        if entry.is_file() and m and m.group(1) < cutoff and m.group(1) in versions:
+            drops.append(entry.path)
+    return sorted(drops)
+
+def apply_retention(manifest, keep_days, drop_legacy, dry_run=False):
+    with step('compact.retention', keep_days=keep_days) as s:
+        paths = expired_drops(manifest, keep_days) if keep_days >= 0 else []
+        if drop_legacy and manifest.get('legacy_imported') and os.path.exists(raw_store.LEGACY_HISTORY_PATH):
+            paths.append(raw_store.LEGACY_HISTORY_PATH)
+        freed = sum(os.path.getsize(p) for p in paths)
+        if not dry_run:
+            for path in paths:
+                os.remove(path)
+        s.fields.update(files=len(paths), bytes_freed=freed, dry_run=dry_run)
+    return paths, freed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge closed months of daily raw partitions into monthly ones and apply retention to raw drops.')
+    parser.add_argument('--grace-days', type=int, default=7, help='A month is compacted once the newest stored date is more than this many days past its end.')
+    parser.add_argument('--keep-days', type=int, default=30, help='Delete daily_YYYY-MM-DD.csv drops more than this many days older than the newest stored date (-1 keeps them all).')
+    parser.add_argument('--drop-legacy', action='store_true', help='Also delete raw_history.csv once it has been imported into the store.')
+    parser.add_argument('--dry-run', action='store_true', help='Only report what would be compacted and deleted.')
+    args = parser.parse_args(argv)
+
+    ensure_dirs()
+    with store_lock():
+        manifest = raw_store.migrate_legacy()
+        if not raw_store.has_data(manifest):
+            raise SystemExit('No raw history found. Run generate_fake_data.py first.')
+        months = compact(manifest, args.grace_days, args.dry_run)
+        paths, freed = apply_retention(manifest, args.keep_days, args.drop_legacy, args.dry_run)
+    span = f" ({min(months)} .. {max(months)})" if months else ''
+    print(f"{'Would compact' if args.dry_run else 'Compacted'} {sum(len(v) for v in months.values()):,} daily partition(s) into {len(months):,} monthly partition(s){span}; "
+          f"{'would delete' if args.dry_run else 'deleted'} {len(paths):,} raw drop file(s), {freed / 1e6:,.1f} MB")
+
+if __name__ == '__main__':
+    main()
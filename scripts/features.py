@@ -0,0 +1,81 @@
+from datetime import date
+import numpy as np
+import pandas as pd
+import periods
+import rollups
+from periods import PERIOD
+
+# Trend features per (period, market, account), derived from the account rollup: week-over-week change,
+# rolling 4- and 13-week totals and attainment, and ISO-year-to-date totals. Every market/account has a row
+# for each week from its first appearance to the latest period (zeros where it had no activity), so windows
+# are fixed row offsets within a group, and all sums are integer, so incremental updates match full builds.
+NAME = 'features'
+KEYS = [PERIOD,'market','account']
+GROUP = ['market','account']
+WINDOWS = {'4w': 4, '13w': 13}
+LOOKBACK = max(WINDOWS.values()) - 1
+
+def week_number(keys):
+    # Consecutive integer per ISO week (Mondays since 0001-01-01), so gaps and year ends are plain arithmetic.
+    uniq, inv = np.unique(np.asarray(keys), return_inverse=True)
+    return np.array([(periods.monday(k).toordinal() - 1) // 7 for k in uniq], dtype='int64')[inv]
+
+def week_period(weeks):
+    uniq, inv = np.unique(weeks, return_inverse=True)
+    return np.array([date.fromordinal(int(w) * 7 + 1).isocalendar()[:2] for w in uniq]).dot([100, 1]).astype('int32')[inv]
+
+def first_week(since):
+    # Earliest week a build from `since` needs: the start of its ISO year, or LOOKBACK weeks back if earlier.
+    year_start = week_number([periods.split(since)[0] * 100 + 1])[0]
+    return min(year_start, week_number([since])[0] - LOOKBACK)
+
+def ratio(num, den):
+    return np.where(den > 0, num / np.where(den > 0, den, 1), np.nan)
+
+def build(account, since=None):
+    # Features for every period, or only periods >= since (reading just the lookback they depend on).
+    acc = account[KEYS + ['goal','sales']].assign(wk=week_number(account[PERIOD]))
+    first = acc.groupby(GROUP, observed=True)['wk'].min()
+    start = first_week(since) if since is not None else first.min()
+    acc = acc[acc['wk'] >= start]
+
+    # Dense grid: one row per group and week, group-major and week-ascending.
+    starts = np.maximum(first.to_numpy(), start)
+    last = acc['wk'].max() if len(acc) else start - 1
+    lengths = np.maximum(last - starts + 1, 0)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    pos = np.arange(lengths.sum()) - offsets
+    grid = pd.DataFrame({col: first.index.get_level_values(col).repeat(lengths) for col in GROUP})
+    grid['wk'] = np.repeat(starts, lengths) + pos
+    grid = grid.merge(acc[GROUP + ['wk','goal','sales']], on=GROUP + ['wk'], how='left', sort=False)
+    grid[['goal','sales']] = grid[['goal','sales']].fillna(0).astype('int64')
+    grid[PERIOD] = week_period(grid['wk'].to_numpy())
+
+    out = grid[KEYS + ['goal','sales']].copy()
+    out['pct_attained'] = ratio(out['sales'], out['goal'])
+    sales = out['sales'].to_numpy()
+    prev = np.where(pos >= 1, np.roll(sales, 1), 0)
+    out['sales_prev_week'] = prev
+    out['wow_change'] = sales - prev
+    out['wow_pct'] = ratio(sales - prev, prev)
+    csum = out.groupby(GROUP, observed=True, sort=False)[['goal','sales']].cumsum()
+    for label, n in WINDOWS.items():
+        for col in ['goal','sales']:
+            c = csum[col].to_numpy()
+            out[f'{col}_{label}'] = c - np.where(pos >= n, np.roll(c, n), 0)
+        out[f'pct_attained_{label}'] = ratio(out[f'sales_{label}'], out[f'goal_{label}'])
+    ytd = out.groupby(GROUP + [out[PERIOD] // 100], observed=True, sort=False)[['goal','sales']].cumsum()
+    out['goal_ytd'], out['sales_ytd'] = ytd['goal'], ytd['sales']
+    out['pct_attained_ytd'] = ratio(out['sales_ytd'], out['goal_ytd'])
+
+    if since is not None:
+        out = out[out[PERIOD] >= since]
+    return rollups.with_year_week(out.sort_values(KEYS, kind='mergesort', ignore_index=True))
+
+def update(existing, account, since):
+    # Rows before `since` cannot change; everything from it on is rebuilt. Returns the table and the periods
+    # that were replaced.
+    fresh = build(account, since)
+    replaced = set(existing[PERIOD][existing[PERIOD] >= since].unique().tolist()) | set(fresh[PERIOD].unique().tolist())
+    table = pd.concat([existing[existing[PERIOD] < since], fresh], ignore_index=True)
+    return table, replaced
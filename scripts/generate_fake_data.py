@@ -1,65 +1,152 @@
-
 import os
-import random
+import time
 import argparse
+import itertools
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 import numpy as np
 import pandas as pd
-from utils import ensure_dirs, RAW_DIR, MARKETS, ACCOUNTS, BRANDS, REPS, CATEGORIES
+import raw_store
+import validate
+from utils import step, ensure_dirs, store_lock, RAW_DIR, SPOOL_DIR, MARKETS, ACCOUNTS, BRANDS, REPS, CATEGORIES, RAW_COLUMNS
+
+# Distinct keys (market, account, brand, rep) a day can hold; more draws than this per day only repeat keys.
+KEYS_PER_DAY = len(MARKETS) * len(ACCOUNTS) * len(BRANDS) * len(REPS)
+BASE_GOAL = np.array([{'Wine':120,'Spirits':100,'Beer':150}[c] for c in CATEGORIES], dtype=float)
 
-random.seed(42)
-np.random.seed(42)
+def generate_day(run_date, rows=800, seed=42):
+    rng = np.random.default_rng([seed, run_date.toordinal()])
+    m = rng.integers(0, len(MARKETS), rows)
+    a = rng.integers(0, len(ACCOUNTS), rows)
+    b = rng.integers(0, len(BRANDS), rows)
+    c = rng.integers(0, len(CATEGORIES), rows)
+    r = rng.integers(0, len(REPS), rows)
+    account_factor = 1.0 + a*0.05
+    market_factor = 1.0 + m*0.07
+    daily_goal = np.maximum(rng.normal(BASE_GOAL[c]*account_factor*market_factor, 15).astype(np.int64), 20)
+    displays = rng.poisson(1, rows)
+    pods = np.maximum(rng.normal(12, 3, rows).astype(np.int64), 1)
+    voids = rng.poisson(1, rows)
+    uplift = 1.0 + 0.10*displays
+    void_penalty = 1.0 - np.minimum(voids*0.03, 0.4)
+    noise = rng.normal(0.95, 0.1, rows)
+    sales = np.maximum(0, daily_goal*uplift*void_penalty*noise).astype(np.int64)
+    # The draws repeat keys (date, market, account, brand, rep); only the last row per key is kept, the one
+    # the store would keep, so generated drops pass validation instead of filling the quarantine.
+    key = ((m*len(ACCOUNTS) + a)*len(BRANDS) + b)*len(REPS) + r
+    keep = np.sort(rows - 1 - np.unique(key[::-1], return_index=True)[1])
+    m, a, b, c, r, daily_goal, sales, displays, pods, voids = (v[keep] for v in (m, a, b, c, r, daily_goal, sales, displays, pods, voids))
+    return pd.DataFrame({
+        'date': run_date.isoformat(),
+        'market': pd.Categorical.from_codes(m, MARKETS),
+        'account': pd.Categorical.from_codes(a, ACCOUNTS),
+        'brand': pd.Categorical.from_codes(b, BRANDS),
+        'category': pd.Categorical.from_codes(c, CATEGORIES),
+        'rep': pd.Categorical.from_codes(r, REPS),
+        'goal': daily_goal, 'sales_volume': sales, 'displays': displays, 'pods': pods, 'voids': voids,
+    }, columns=RAW_COLUMNS)
 
-parser = argparse.ArgumentParser(description='Generate simulated CPWS-style data over N days.')
-parser.add_argument('--days', type=int, default=1, help='Number of days to generate (backwards from today)')
-parser.add_argument('--start', type=str, default=None, help='Optional start date YYYY-MM-DD. If provided, goes forward N days.')
-parser.add_argument('--force', action='store_true', help='Overwrite existing daily files and rebuild history for those days.')
-args = parser.parse_args()
+def write_drop(df, path):
+    # Written under a temporary name and renamed, so a watcher never picks up a half-written file.
+    tmp = path + '.tmp'
+    df.to_csv(tmp, index=False)
+    os.replace(tmp, path)
+
+def build_day(run_date, rows=800, seed=42, force=False):
+    df_day = generate_day(run_date, rows, seed)
+    daily_path = os.path.join(RAW_DIR, f'daily_{run_date.isoformat()}.csv')
+    if not os.path.exists(daily_path) or force:
+        write_drop(df_day, daily_path)
+    return df_day
 
-ensure_dirs()
+def stream(date_list, rows=800, seed=42, batch_rows=100, interval=1.0, spool=SPOOL_DIR):
+    # Load-test mode: each day's rows are dropped into the spool as intra-day batches of batch_rows, one batch
+    # every interval seconds, for the ingest daemon to pick up. The raw store is left to the daemon.
+    os.makedirs(spool, exist_ok=True)
+    n, t0 = 0, time.perf_counter()
+    for run_date in date_list:
+        df_day = generate_day(run_date, rows, seed)
+        for i, start in enumerate(range(0, len(df_day), batch_rows)):
+            batch = df_day.iloc[start:start + batch_rows]
+            write_drop(batch, os.path.join(spool, f'batch_{run_date.isoformat()}_{i:05d}.csv'))
+            n += len(batch)
+            print(f'{run_date} batch {i}: {len(batch):,} rows ({n / (time.perf_counter() - t0):,.0f} rows/sec sustained)', flush=True)
+            if interval:
+                time.sleep(interval)
+    return n
 
-if args.start:
-    start_date = datetime.strptime(args.start, '%Y-%m-%d').date()
-    date_list = [start_date + timedelta(days=i) for i in range(max(1, args.days))]
-else:
+def date_range(days, start=None):
+    if start:
+        start_date = datetime.strptime(start, '%Y-%m-%d').date()
+        return [start_date + timedelta(days=i) for i in range(max(1, days))]
     today = datetime.utcnow().date()
-    date_list = [today - timedelta(days=i) for i in range(max(1, args.days))][::-1]
+    return [today - timedelta(days=i) for i in range(max(1, days))][::-1]
 
-all_new = []
-for run_date in date_list:
-    rows = []
-    for _ in range(800):
-        market = random.choice(MARKETS)
-        account = random.choice(ACCOUNTS)
-        brand = random.choice(BRANDS)
-        category = random.choice(CATEGORIES)
-        rep = random.choice(REPS)
-        base_goal = {'Wine':120,'Spirits':100,'Beer':150}[category]
-        account_factor = 1.0 + (ACCOUNTS.index(account)*0.05)
-        market_factor = 1.0 + (MARKETS.index(market)*0.07)
-        daily_goal = int(np.random.normal(base_goal*account_factor*market_factor,15))
-        daily_goal = max(daily_goal, 20)
-        displays = max(0, int(np.random.poisson(1)))
-        pods = max(1, int(np.random.normal(12,3)))
-        voids = max(0, int(np.random.poisson(1)))
-        uplift = 1.0 + 0.10*displays
-        void_penalty = 1.0 - min(voids*0.03, 0.4)
-        noise = np.random.normal(0.95, 0.1)
-        sales = int(max(0, daily_goal*uplift*void_penalty*noise))
-        rows.append({'date':run_date.isoformat(),'market':market,'account':account,'brand':brand,'category':category,'rep':rep,'goal':daily_goal,'sales_volume':sales,'displays':displays,'pods':pods,'voids':voids})
-    df_day = pd.DataFrame(rows)
-    daily_path = os.path.join(RAW_DIR, f'daily_{run_date.isoformat()}.csv')
-    if not os.path.exists(daily_path) or args.force:
-        df_day.to_csv(daily_path, index=False)
-    all_new.append(df_day)
+def generate_days(date_list, rows=800, seed=42, force=False, workers=1, pool=None):
+    if pool is None or len(date_list) == 1:
+        return [build_day(d, rows, seed, force) for d in date_list]
+    n = len(date_list)
+    return list(pool.map(build_day, date_list, [rows]*n, [seed]*n, [force]*n, chunksize=max(1, n // (workers*4))))
+
+def merge_quality(total, quality):
+    total['rows'] += quality['rows']
+    total['passed'] += quality['passed']
+    total['quarantined'] += quality['quarantined']
+    for reason, n in quality['reasons'].items():
+        total['reasons'][reason] = total['reasons'].get(reason, 0) + n
+    if quality['quarantine']:
+        total['quarantine'] = ', '.join(filter(None, [total['quarantine'], quality['quarantine']]))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate simulated CPWS-style data over N days.')
+    parser.add_argument('--days', type=int, default=1, help='Number of days to generate (backwards from today)')
+    parser.add_argument('--start', type=str, default=None, help='Optional start date YYYY-MM-DD. If provided, goes forward N days.')
+    parser.add_argument('--force', action='store_true', help='Overwrite existing daily files and replace the raw store partitions for those days.')
+    parser.add_argument('--rows-per-day', type=int, default=800, help=f'Rows drawn per day. Repeated keys are collapsed to their last row, so a day keeps at most {KEYS_PER_DAY} rows (about 505 of 800 draws).')
+    parser.add_argument('--seed', type=int, default=42, help='Base seed; each day is seeded from (seed, date) so output does not depend on run order.')
+    parser.add_argument('--workers', type=int, default=1, help='Generate days across a process pool of this size.')
+    parser.add_argument('--stream', action='store_true', help='Drop each day into the spool directory as small intra-day batches for ingest.py instead of writing the raw store.')
+    parser.add_argument('--batch-rows', type=int, default=100, help='Rows per streamed batch.')
+    parser.add_argument('--interval', type=float, default=1.0, help='Seconds between streamed batches (0 for as fast as possible).')
+    parser.add_argument('--spool', default=SPOOL_DIR, help='Directory streamed batches are written to.')
+    args = parser.parse_args(argv)
 
-history_path = os.path.join(RAW_DIR, 'raw_history.csv')
-if os.path.exists(history_path) and not args.force:
-    hist = pd.read_csv(history_path)
-else:
-    hist = pd.DataFrame(columns=['date','market','account','brand','category','rep','goal','sales_volume','displays','pods','voids'])
+    ensure_dirs()
+    date_list = date_range(args.days, args.start)
+    if args.stream:
+        with step('generate.stream', days=len(date_list), batch_rows=args.batch_rows) as s:
+            s.rows_out = stream(date_list, args.rows_per_day, args.seed, args.batch_rows, args.interval, args.spool)
+        return
+    # Days are generated, validated and upserted one calendar month at a time, so memory is bounded by a
+    # month of rows however long the range is.
+    quality = {'rows': 0, 'passed': 0, 'quarantined': 0, 'reasons': {}, 'quarantine': None}
+    written, inserted, overwrites, drawn, kept, elapsed = set(), 0, 0, 0, 0, 0.0
+    pool = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    try:
+        for _, month in itertools.groupby(date_list, key=lambda d: (d.year, d.month)):
+            month = list(month)
+            t0 = time.perf_counter()
+            with step('generate.days', days=len(month), workers=args.workers) as s:
+                new = generate_days(month, args.rows_per_day, args.seed, args.force, args.workers, pool)
+                s.rows_in, s.rows_out = len(month) * args.rows_per_day, sum(len(d) for d in new)
+            elapsed += time.perf_counter() - t0
+            drawn += len(month) * args.rows_per_day
+            kept += sum(len(d) for d in new)
+            with store_lock():
+                manifest = raw_store.migrate_legacy()
+                df, month_quality = validate.run({'generate': pd.concat(new, ignore_index=True)})
+                del new
+                stats = raw_store.upsert(df, replace=args.force, manifest=manifest)
+            merge_quality(quality, month_quality)
+            written.update(stats['partitions_written'])
+            inserted += stats['inserted']
+            overwrites += stats['overwrites']
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print(f"Generated {len(date_list)} day(s): {drawn:,} rows drawn ({drawn/max(elapsed,1e-9):,.0f} rows/sec), {kept:,} kept after collapsing repeated keys; {validate.describe(quality)}; "
+          f"{len(written)} partition(s) written; {inserted:,} new key(s), {overwrites:,} overwritten; "
+          f"history rows: {raw_store.total_rows(manifest):,}")
 
-combined = pd.concat([hist]+all_new, ignore_index=True)
-combined.drop_duplicates(subset=['date','market','account','brand','rep'], keep='last', inplace=True)
-combined.to_csv(history_path, index=False)
-print(f"Generated {len(date_list)} day(s); history rows: {len(combined):,}")
+if __name__ == '__main__':
+    main()
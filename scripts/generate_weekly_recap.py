@@ -1,89 +1,171 @@
-
 import os
-import pandas as pd
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 from reportlab.lib.pagesizes import LETTER
 from reportlab.pdfgen import canvas
 from reportlab.lib.units import inch
 from reportlab.lib import colors
-from utils import PROCESSED_DIR, RECAPS_DIR
-
-processed_path = os.path.join(PROCESSED_DIR, 'processed.csv')
-if not os.path.exists(processed_path):
-    raise SystemExit('Processed data not found. Run process_data.py first.')
-
-df = pd.read_csv(processed_path, parse_dates=['date'])
-
-df['week'] = df['date'].dt.isocalendar().week.astype(int)
-df['year'] = df['date'].dt.year.astype(int)
-latest_week = int(df['week'].max())
-latest_year = int(df[df['week']==latest_week]['year'].max())
-
-week_df = df[(df['year']==latest_year) & (df['week']==latest_week)]
-prev_df = df[(df['year']==latest_year) & (df['week']==latest_week-1)]
-
-wk_market = week_df.groupby('market').agg(goal=('goal','sum'), sales=('sales_volume','sum'), displays=('displays','sum'), voids=('voids','sum')).reset_index()
-wk_market['pct_attained'] = wk_market['sales'] / wk_market['goal'].replace(0,1)
-prev_market = prev_df.groupby('market')['sales_volume'].sum().rename('sales_prev')
-wk_market = wk_market.merge(prev_market, on='market', how='left')
-wk_market['sales_prev'] = wk_market['sales_prev'].fillna(0)
-wk_market['wow_change'] = wk_market['sales'] - wk_market['sales_prev']
-
-wins = wk_market.sort_values('wow_change', ascending=False).head(5)
-risks = wk_market.sort_values('pct_attained', ascending=True).head(5)
-
-os.makedirs(RECAPS_DIR, exist_ok=True)
-report_name = f'recap_{latest_year}-W{latest_week:02d}.pdf'
-report_path = os.path.join(RECAPS_DIR, report_name)
-
-c = canvas.Canvas(report_path, pagesize=LETTER)
-width, height = LETTER
-margin = 0.75 * inch
-
-c.setFillColor(colors.black)
-c.setFont('Helvetica-Bold', 16)
-c.drawString(margin, height - margin, 'CPWS Weekly Recap (Simulated)')
-c.setFont('Helvetica', 10)
-c.drawString(margin, height - margin - 16, f'Week {latest_week}, {latest_year}')
-
-c.setFont('Helvetica-Bold', 12)
-c.drawString(margin, height - margin - 48, 'Market Summary')
-
-c.setFont('Helvetica', 10)
-y = height - margin - 64
-c.drawString(margin, y, 'Market')
-c.drawString(margin + 140, y, '% Attained')
-c.drawString(margin + 240, y, 'Displays')
-c.drawString(margin + 320, y, 'Voids')
-y -= 14
-
-for _, r in wk_market.sort_values('pct_attained', ascending=False).iterrows():
-    c.drawString(margin, y, str(r['market']))
-    c.drawString(margin + 140, y, f"{r['pct_attained']:.0%}")
-    c.drawString(margin + 240, y, str(int(r['displays'])))
-    c.drawString(margin + 320, y, str(int(r['voids'])))
-    y -= 14
-
-y -= 10
-c.setFont('Helvetica-Bold', 12)
-c.drawString(margin, y, 'Top Wins (WoW Sales Change)')
-y -= 16
-c.setFont('Helvetica', 10)
-for _, r in wins.iterrows():
-    c.drawString(margin, y, f"{r['market']}: +{int(r['wow_change'])} units vs LW")
-    y -= 14
-
-y -= 10
-c.setFont('Helvetica-Bold', 12)
-c.drawString(margin, y, 'Top Risks (Lowest % Attained)')
-y -= 16
-c.setFont('Helvetica', 10)
-for _, r in risks.iterrows():
-    c.drawString(margin, y, f"{r['market']}: {r['pct_attained']:.0%} attained")
-    y -= 14
-
-c.setFont('Helvetica', 8)
-c.setFillColor(colors.grey)
-c.drawString(margin, margin, 'Auto-generated via GitHub Actions · Simulated data for demo')
-
-c.save()
-print('Wrote', report_path)
+import tables
+import periods
+import features
+from periods import PERIOD
+from utils import DATA_DIR, RECAPS_DIR, file_checksum, read_json, write_json, step
+
+# Recaps are built from the weekly territory rollup and the precomputed feature table, not the processed rows.
+# STATE_PATH maps each recap file to a hash of the numbers it shows (plus this script), so re-runs and
+# backfills only redraw changed weeks.
+TERRITORY = tables.output('territory_summary')
+TERRITORY_COLUMNS = [PERIOD,'market','goal','sales','displays','voids']
+FEATURES = tables.output(features.NAME)
+FEATURE_COLUMNS = [PERIOD,'market','sales_prev_week']
+STATE_PATH = os.path.join(DATA_DIR, 'recap_state.json')
+CODE_HASH = file_checksum(__file__)
+
+def load_inputs():
+    if not tables.exists(TERRITORY) or not tables.exists(FEATURES):
+        raise SystemExit('Rollups not found. Run process_data.py first.')
+    return tables.read_table(TERRITORY, columns=TERRITORY_COLUMNS, aggregated=True), tables.read_table(FEATURES, columns=FEATURE_COLUMNS, aggregated=True)
+
+def week_summary(terr, feats, key):
+    # Last week's sales come from the feature table, which carries them on every market/account row.
+    wk_market = periods.rows(terr, key)[['market','goal','sales','displays','voids']].reset_index(drop=True)
+    wk_market['pct_attained'] = wk_market['sales'] / wk_market['goal'].replace(0,1)
+    prev_market = periods.rows(feats, key).groupby('market', observed=True)['sales_prev_week'].sum().rename('sales_prev')
+    wk_market = wk_market.merge(prev_market, on='market', how='left')
+    wk_market['sales_prev'] = wk_market['sales_prev'].fillna(0)
+    wk_market['wow_change'] = wk_market['sales'] - wk_market['sales_prev']
+    return wk_market
+
+def report_path(key):
+    return os.path.join(RECAPS_DIR, f'recap_{periods.label(key)}.pdf')
+
+def inputs_hash(wk_market):
+    return hashlib.sha256((CODE_HASH + wk_market.to_csv(index=False)).encode()).hexdigest()
+
+def render(path, key, wk_market):
+    year, week = periods.split(key)
+    with step('recap.draw', week=periods.label(key)) as s:
+        wins = wk_market.sort_values('wow_change', ascending=False).head(5)
+        risks = wk_market.sort_values('pct_attained', ascending=True).head(5)
+
+        c = canvas.Canvas(path, pagesize=LETTER)
+        width, height = LETTER
+        margin = 0.75 * inch
+        y = height - margin
+
+        def footer():
+            c.setFont('Helvetica', 8)
+            c.setFillColor(colors.grey)
+            c.drawString(margin, margin, 'Auto-generated via GitHub Actions · Simulated data for demo')
+            c.setFillColor(colors.black)
+
+        def header():
+            nonlocal y
+            c.setFont('Helvetica', 10)
+            c.drawString(margin, y, 'Market')
+            c.drawString(margin + 140, y, '% Attained')
+            c.drawString(margin + 240, y, 'Displays')
+            c.drawString(margin + 320, y, 'Voids')
+            y -= 14
+
+        def room(space, table_header=False):
+            # Start a new page when the next block would run into the footer.
+            nonlocal y
+            if y - space >= margin + 16:
+                return
+            footer()
+            c.showPage()
+            y = height - margin
+            c.setFont('Helvetica', 10)
+            c.drawString(margin, y, f'Week {week}, {year} (continued)')
+            y -= 30
+            if table_header:
+                header()
+
+        c.setFillColor(colors.black)
+        c.setFont('Helvetica-Bold', 16)
+        c.drawString(margin, y, 'CPWS Weekly Recap (Simulated)')
+        c.setFont('Helvetica', 10)
+        c.drawString(margin, y - 16, f'Week {week}, {year}')
+
+        c.setFont('Helvetica-Bold', 12)
+        c.drawString(margin, y - 48, 'Market Summary')
+        y -= 64
+        header()
+
+        for _, r in wk_market.sort_values('pct_attained', ascending=False).iterrows():
+            room(14, table_header=True)
+            c.setFont('Helvetica', 10)
+            c.drawString(margin, y, str(r['market']))
+            c.drawString(margin + 140, y, f"{r['pct_attained']:.0%}")
+            c.drawString(margin + 240, y, str(int(r['displays'])))
+            c.drawString(margin + 320, y, str(int(r['voids'])))
+            y -= 14
+
+        for title, rows, text in [('Top Wins (WoW Sales Change)', wins, lambda r: f"{r['market']}: +{int(r['wow_change'])} units vs LW"),
+                                  ('Top Risks (Lowest % Attained)', risks, lambda r: f"{r['market']}: {r['pct_attained']:.0%} attained")]:
+            y -= 10
+            room(30)
+            c.setFont('Helvetica-Bold', 12)
+            c.drawString(margin, y, title)
+            y -= 16
+            c.setFont('Helvetica', 10)
+            for _, r in rows.iterrows():
+                room(14)
+                c.setFont('Helvetica', 10)
+                c.drawString(margin, y, text(r))
+                y -= 14
+
+        footer()
+        c.save()
+        s.rows_in = len(wk_market)
+        s.wrote(path)
+    return path
+
+def build(terr, feats, weeks=None, workers=1, force=False):
+    # Returns (written, skipped) recap paths for the given periods, the latest one by default.
+    weeks = weeks or periods.latest(terr[PERIOD])
+    state, jobs, skipped = read_json(STATE_PATH, {}), [], []
+    with step('recap.aggregate') as s:
+        for period in weeks:
+            wk_market = week_summary(terr, feats, period)
+            if wk_market.empty:
+                raise SystemExit(f'No rollup data for {periods.label(period)}.')
+            path, key = report_path(period), inputs_hash(wk_market)
+            if not force and state.get(os.path.basename(path)) == key and os.path.exists(path):
+                skipped.append(path)
+            else:
+                jobs.append((path, period, wk_market, key))
+        s.rows_in, s.rows_out = len(terr), len(jobs)
+    os.makedirs(RECAPS_DIR, exist_ok=True)
+    if workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            written = list(pool.map(render, *zip(*[job[:3] for job in jobs])))
+    else:
+        written = [render(*job[:3]) for job in jobs]
+    for path, _, _, key in jobs:
+        state[os.path.basename(path)] = key
+    if jobs:
+        write_json(STATE_PATH, state)
+    return written, skipped
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render weekly recap PDFs from the territory rollup.')
+    parser.add_argument('--weeks', nargs='+', type=periods.parse, default=None, metavar='YYYY-Www', help='Render these weeks instead of the latest one.')
+    parser.add_argument('--all', action='store_true', help='Backfill a recap for every week in the rollup.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Render across a process pool of this size.')
+    parser.add_argument('--force', action='store_true', help='Redraw recaps even when their inputs are unchanged.')
+    args = parser.parse_args(argv)
+
+    terr, feats = load_inputs()
+    weeks = periods.unique(terr[PERIOD]).tolist() if args.all else args.weeks
+    with step('generate_weekly_recap'):
+        written, skipped = build(terr, feats, weeks, args.workers, args.force)
+    if len(written) + len(skipped) == 1:
+        print('Wrote' if written else 'Unchanged', (written or skipped)[0])
+    else:
+        print(f'Wrote {len(written)} recap(s), {len(skipped)} unchanged.')
+
+if __name__ == '__main__':
+    main()
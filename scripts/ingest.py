@@ -0,0 +1,126 @@
+import os
+import re
+import time
+import argparse
+import raw_store
+import tables
+import process_data
+import build_dashboard
+import features
+import validate
+import compact
+from utils import DATA_DIR, SPOOL_DIR, ensure_dirs, read_json, write_json, step, store_lock
+
+# Long-running ingest: polls the watched directories for drop files that are new or changed since they
+# were last ingested (by size and mtime), upserts only those into the raw store, runs the incremental
+# processing step (which rebuilds just the weeks the new rows fall in) and, with --dashboard, republishes the
+# static site. Two kinds of file are drops: daily_YYYY-MM-DD.csv holds a whole day and replaces it in the
+# store, and batch_*.csv (e.g. the generator's streamed intra-day batches) is merged key by key. Every file
+# is validated on its own first; rows failing validation go to the quarantine instead of the store. A batch
+# that upserts rows or derives processed rows bumps 'version' in STATE_PATH; the app and site already reload
+# on changed outputs.
+STATE_PATH = os.path.join(DATA_DIR, 'ingest_state.json')
+BATCH_PATTERN = re.compile(r'batch_.+\.csv$')
+
+def scan(dirs, seen):
+    # (path, [size, mtime_ns]) of drop files not yet ingested in their current form, oldest first.
+    found = []
+    for d in dirs:
+        if not os.path.isdir(d):
+            continue
+        for entry in os.scandir(d):
+            if entry.is_file() and is_drop(entry.path):
+                st = entry.stat()
+                sig = [st.st_size, st.st_mtime_ns]
+                if seen.get(entry.path) != sig:
+                    found.append((entry.path, sig))
+    return sorted(found, key=lambda f: (f[1][1], f[0]))
+
+def is_day_drop(path):
+    return compact.DROP_PATTERN.match(os.path.basename(path)) is not None
+
+def is_drop(path):
+    if os.path.abspath(path) == os.path.abspath(raw_store.LEGACY_HISTORY_PATH):
+        return False
+    return is_day_drop(path) or BATCH_PATTERN.match(os.path.basename(path)) is not None
+
+def read_drops(paths):
+    return validate.run({p: validate.read_drop(p) for p in paths}) if paths else (None, None)
+
+def publish_dashboard(frames):
+    df = frames.get('processed')
+    df = df[build_dashboard.PROCESSED_COLUMNS] if df is not None else tables.read_table(tables.PROCESSED, columns=build_dashboard.PROCESSED_COLUMNS)
+    terr, acc, feats = (frames[n] if n in frames else tables.read_table(tables.output(n), aggregated=True) for n in ('territory_summary', 'account_summary', features.NAME))
+    return build_dashboard.build(df, terr, acc, feats)
+
+def ingest_batch(files, args, state):
+    with step('ingest.batch', files=len(files)) as s:
+        # The store lock is held from loading the manifest until processing has caught up with the new rows.
+        with store_lock():
+            manifest = raw_store.migrate_legacy()
+            rows_in = quarantined = upserted = 0
+            # Whole-day drops first (they replace their day), then partial batches merged on top in arrival order.
+            for replace, group in [(True, [p for p, _ in files if is_day_drop(p)]), (False, [p for p, _ in files if not is_day_drop(p)])]:
+                df, quality = read_drops(group)
+                if df is not None:
+                    s.read(*group)
+                    rows_in += quality['rows']
+                    quarantined += quality['quarantined']
+                    if quality['quarantine']:
+                        print(validate.describe(quality), flush=True)
+                    if len(df):
+                        raw_store.upsert(df, replace=replace, manifest=manifest)
+                        upserted += len(df)
+            opts = process_data.parse_args(['--format', args.format] + (['--sqlite'] if args.sqlite else []))
+            mode, rows, frames = process_data.run(opts)
+        changed = upserted or rows
+        if changed and args.dashboard:
+            publish_dashboard(frames)
+        for path, sig in files:
+            state['files'][path] = sig
+            if args.remove:
+                os.remove(path)
+                del state['files'][path]
+        if changed:
+            state['version'] += 1
+            state['published'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        # Files are recorded either way, so unchanged or unreadable ones are not picked up again.
+        write_json(STATE_PATH, state)
+        # Lag: from the oldest file's last write to the new version being published.
+        lag = time.time() - min(sig[1] for _, sig in files) / 1e9
+        s.rows_in, s.rows_out = rows_in, rows
+        s.fields.update(version=state['version'], mode=mode, quarantined=quarantined, changed=bool(changed))
+        if changed:
+            s.fields['lag_seconds'] = round(lag, 3)
+    if not changed:
+        print(f"v{state['version']} unchanged: {len(files)} file(s), {rows_in:,} rows in, {quarantined:,} quarantined, nothing to store", flush=True)
+        return
+    print(f"v{state['version']}: {len(files)} file(s), {rows_in:,} rows in, {quarantined:,} quarantined, {rows:,} rows derived ({mode}), lag {lag:.2f}s", flush=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watch drop directories and ingest new or changed files as they arrive.')
+    parser.add_argument('--dirs', nargs='+', default=[SPOOL_DIR], help='Directories to watch (default: the spool; add data/raw to pick up daily drops).')
+    parser.add_argument('--poll', type=float, default=1.0, help='Seconds between directory scans.')
+    parser.add_argument('--once', action='store_true', help='Ingest whatever is pending and exit.')
+    parser.add_argument('--remove', action='store_true', help='Delete drop files once they are ingested (treat the directory as a queue).')
+    parser.add_argument('--dashboard', action='store_true', help='Republish the static dashboard after every batch.')
+    parser.add_argument('--format', choices=list(tables.FORMATS), default=tables.DEFAULT_FORMAT, help='Storage format for processed rows and rollups.')
+    parser.add_argument('--sqlite', action='store_true', help='Keep the SQLite store up to date as well.')
+    args = parser.parse_args(argv)
+
+    ensure_dirs()
+    state = read_json(STATE_PATH, {'files': {}, 'version': 0})
+    print(f"Watching {', '.join(args.dirs)} (version {state['version']})", flush=True)
+    try:
+        while True:
+            files = scan(args.dirs, state['files'])
+            if files:
+                ingest_batch(files, args, state)
+            if args.once:
+                break
+            time.sleep(args.poll)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+
+# A week is identified everywhere by one sortable integer, ISO year * 100 + ISO week (2026-W01 -> 202601).
+# It is computed once in processing; processed rows and weekly rollups are stored sorted by it, so a week or
+# a range of weeks is a binary search on the column instead of a boolean mask over the whole frame.
+PERIOD = 'period'
+
+def period_key(dates):
+    iso = pd.to_datetime(pd.Series(dates)).dt.isocalendar()
+    return (iso['year'].astype('int32') * 100 + iso['week'].astype('int32')).to_numpy()
+
+def split(key):
+    return int(key) // 100, int(key) % 100
+
+def label(key):
+    year, week = split(key)
+    return f'{year}-W{week:02d}'
+
+def parse(text):
+    year, _, week = str(text).upper().partition('-W')
+    if not week:
+        raise ValueError(f'expected YYYY-Www, got {text!r}')
+    key = int(year) * 100 + int(week)
+    monday(key)
+    return key
+
+def monday(key):
+    return date.fromisocalendar(*split(key), 1)
+
+def shift(key, n):
+    year, week, _ = (monday(key) + timedelta(weeks=n)).isocalendar()
+    return year * 100 + week
+
+def previous(key):
+    return shift(key, -1)
+
+def unique(keys):
+    # Distinct periods of a sorted key column, without hashing the whole column.
+    keys = np.asarray(keys)
+    if not len(keys):
+        return keys
+    return keys[np.r_[True, keys[1:] != keys[:-1]]]
+
+def latest(keys, n=1):
+    # The last n distinct periods of a sorted key column, oldest first.
+    keys = np.asarray(keys)
+    found = []
+    end = len(keys)
+    while end and len(found) < n:
+        key = keys[end - 1]
+        found.append(int(key))
+        end = int(np.searchsorted(keys, key, side='left'))
+    return found[::-1]
+
+def bounds(keys, start, end=None):
+    keys = np.asarray(keys)
+    return int(np.searchsorted(keys, start, side='left')), int(np.searchsorted(keys, start if end is None else end, side='right'))
+
+def rows(df, start, end=None):
+    # Rows of a frame sorted by period with start <= period <= end (a single period when end is omitted).
+    lo, hi = bounds(df[PERIOD].to_numpy(), start, end)
+    return df.iloc[lo:hi]
@@ -1,46 +1,329 @@
-
 import os
+import sys
+import argparse
+import tempfile
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-from utils import ensure_dirs, RAW_DIR, PROCESSED_DIR, OUTPUTS_DIR
+import raw_store
+import rollups
+import features
+import tables
+import periods
+import sqlite_store
+from rollups import CUBE_KEYS
+from periods import PERIOD
+from utils import ensure_dirs, apply_schema, read_json, write_json, step, store_lock, RAW_DIR, PROCESSED_DIR, OUTPUTS_DIR
+
+WATERMARK_PATH = os.path.join(PROCESSED_DIR, 'manifest.json')
+# Bumped when the processed layout changes; outputs written under another version are rebuilt in full.
+SCHEMA_VERSION = 2
+
+ACCOUNT_LIFT = {'Tom Thumb':0.08,'Kroger':0.10,'Central Market':0.07,'Whole Foods':0.06,'Market Street':0.09}
+
+def derive(df):
+    with step('process.derive') as s:
+        df['date'] = pd.to_datetime(df['date'])
+        apply_schema(df)
+
+        df['gap_to_goal'] = df['goal'] - df['sales_volume']
+        df['pct_attained'] = np.where(df['goal']>0, df['sales_volume']/df['goal'], np.nan)
+
+        account_lift = df['account'].map(ACCOUNT_LIFT).astype(float).fillna(0.07)
+        base_lift = 1.0 + account_lift * df['displays']
+        df['expected_no_display'] = (df['sales_volume']/base_lift).round(0)
+        df['uplift_estimate'] = (df['sales_volume'] - df['expected_no_display']).clip(lower=0)
+
+        iso = df['date'].dt.isocalendar()
+        df['week'] = iso['week'].astype('int16')
+        df['year'] = iso['year'].astype('int16')
+        df[PERIOD] = df['year'].astype('int32') * 100 + df['week']
+        s.rows_in = s.rows_out = len(df)
+    return df
+
+def week_keys(dates):
+    return {int(k) for k in periods.period_key(list(dates))}
+
+def in_weeks(df, keys):
+    return df[PERIOD].isin(list(keys)).to_numpy()
+
+def load_watermark():
+    return read_json(WATERMARK_PATH)
+
+def save_watermark(raw_manifest, dates, weeks, opts):
+    watermark = {'partitions': raw_manifest['partitions'], 'dates': sorted(dates), 'weeks': sorted(int(k) for k in weeks), 'format': opts.format, 'sqlite': opts.sqlite, 'schema': SCHEMA_VERSION}
+    write_json(WATERMARK_PATH, watermark)
+
+def date_strings(df):
+    return set(df['date'].dt.strftime('%Y-%m-%d').unique())
+
+def present_weeks(df):
+    return {int(k) for k in df[PERIOD].unique()}
+
+def processed_writers(opts):
+    writers = [tables.TableWriter(tables.PROCESSED, opts.format)]
+    if opts.csv and opts.format != 'csv':
+        writers.append(tables.TableWriter(tables.PROCESSED, 'csv', export=True))
+    return writers
+
+def sqlite_writer(opts):
+    # Without --sqlite a database left by an earlier run is removed, so nothing queries stale rows.
+    if opts.sqlite:
+        return sqlite_store.Writer()
+    sqlite_store.drop()
+
+def write_processed(df, opts):
+    tables.write_table(df, tables.PROCESSED, opts.format)
+    if opts.csv and opts.format != 'csv':
+        tables.export_csv(df, tables.PROCESSED)
+
+def write_outputs(cube, rollup_tables, opts):
+    tables.write_table(apply_schema(cube, metrics=False), tables.CUBE, opts.format)
+    for name, table in rollup_tables.items():
+        table = apply_schema(table, metrics=False)
+        tables.write_table(table, tables.output(name), opts.format)
+        if opts.csv and opts.format != 'csv':
+            tables.export_csv(table, tables.output(name))
+
+def build_rollups(df, cube=None):
+    with step('process.rollups') as s:
+        cube = rollups.build_cube(df) if cube is None else cube
+        rollup_tables = rollups.rollup_all(cube)
+        rollup_tables[features.NAME] = features.build(rollup_tables['account_summary'])
+        s.rows_in, s.rows_out = len(df), len(cube)
+    return cube, rollup_tables
+
+def week_shards(raw_manifest, n):
+    # Splits the history into up to n contiguous runs of whole ISO weeks with roughly equal row counts, as
+    # (first Monday, last Sunday). Every period, and so every cube cell, lies in exactly one shard.
+    rows = {}
+    for _, entry in raw_store.partitions(raw_manifest):
+        # A monthly partition's rows are spread evenly over its dates.
+        for day in pd.to_datetime(entry['dates']):
+            monday = day - pd.Timedelta(days=day.weekday())
+            rows[monday] = rows.get(monday, 0) + entry['rows'] / len(entry['dates'])
+    mondays = sorted(rows)
+    cuts = np.searchsorted(np.cumsum([rows[m] for m in mondays]), np.arange(1, n) * sum(rows.values()) / n, side='right')
+    bounds = [0] + sorted(set(int(c) for c in cuts if 0 < c < len(mondays))) + [len(mondays)]
+    return [(mondays[lo], mondays[hi - 1] + pd.Timedelta(days=6)) for lo, hi in zip(bounds, bounds[1:])]
+
+def derive_shard(raw_manifest, start, end):
+    df = derive(raw_store.read_history(start=start, end=end, manifest=raw_manifest))
+    return df, rollups.build_cube(df)
+
+def sharded_derive(raw_manifest, workers):
+    # Map: each worker reads, derives and cubes its own weeks. Reduce: shards are concatenated in date order,
+    # which is the serial row order, and the partial cubes are disjoint so combining them is a plain merge.
+    shards = week_shards(raw_manifest, workers)
+    with step('process.shards', shards=len(shards)) as s:
+        with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+            results = list(pool.map(derive_shard, [raw_manifest] * len(shards), *zip(*shards)))
+        df = pd.concat([r[0] for r in results], ignore_index=True)
+        cube = rollups.combine([r[1] for r in results])
+        s.rows_out = len(df)
+    return df, cube
+
+def full_rebuild(raw_manifest, opts):
+    if opts.workers > 1:
+        df, cube = sharded_derive(raw_manifest, opts.workers)
+    else:
+        df, cube = derive(raw_store.read_history(manifest=raw_manifest)), None
+    write_processed(df, opts)
+    cube, rollup_tables = build_rollups(df, cube)
+    write_outputs(cube, rollup_tables, opts)
+    db = sqlite_writer(opts)
+    if db:
+        db.write(df)
+        db.close(rollup_tables)
+    save_watermark(raw_manifest, date_strings(df), present_weeks(df), opts)
+    return 'full', len(df), dict(rollup_tables, processed=df)
+
+def streaming_rebuild(raw_manifest, opts):
+    # Same outputs as full_rebuild with memory bounded by --chunk-rows: each chunk is derived, appended to the
+    # processed table and folded into a partial cube; the rollups come from the merged cube.
+    writers, db = processed_writers(opts), sqlite_writer(opts)
+    partials, dates, weeks, rows = [], set(), set(), 0
+    for chunk in raw_store.iter_chunks(opts.chunk_rows, manifest=raw_manifest):
+        chunk = derive(chunk)
+        for w in writers:
+            w.write(chunk)
+        if db:
+            db.write(chunk)
+        with step('process.cube', chunk=True) as s:
+            partials.append(rollups.build_cube(chunk))
+            s.rows_in = len(chunk)
+        if len(partials) >= 8:
+            partials = [rollups.combine(partials)]
+        dates |= date_strings(chunk)
+        weeks |= present_weeks(chunk)
+        rows += len(chunk)
+    for w in writers:
+        w.close()
+    with step('process.rollups') as s:
+        cube = rollups.combine(partials)
+        rollup_tables = rollups.rollup_all(cube)
+        rollup_tables[features.NAME] = features.build(rollup_tables['account_summary'])
+        s.rows_in, s.rows_out = rows, len(cube)
+    write_outputs(cube, rollup_tables, opts)
+    if db:
+        db.close(rollup_tables)
+    save_watermark(raw_manifest, dates, weeks, opts)
+    return 'full, streaming', rows, rollup_tables
+
+def changed_dates(raw_manifest, watermark):
+    # Compared per date rather than per partition, so compacting days into a month rebuilds nothing.
+    old, new = raw_store.date_versions(watermark), raw_store.date_versions(raw_manifest)
+    return {d for d in set(old) | set(new) if old.get(d) != new.get(d)}
+
+def splice(existing, fresh, keys, sort_keys):
+    kept = existing[~in_weeks(existing, keys)]
+    return pd.concat([kept, fresh], ignore_index=True).sort_values(sort_keys, kind='mergesort', ignore_index=True)
+
+def streaming_splice(fresh, keys, opts):
+    # splice() of the processed table one stored batch at a time. Both sides are date-ordered and a date
+    # belongs to exactly one period, so fresh rows are merged in batch by batch.
+    dates = fresh['date'].to_numpy()
+    writers = processed_writers(opts)
+    pos = 0
+    for batch in tables.iter_table(tables.PROCESSED, opts.chunk_rows):
+        kept = batch[~in_weeks(batch, keys)]
+        if kept.empty:
+            continue
+        end = int(np.searchsorted(dates, kept['date'].to_numpy()[-1], side='right'))
+        piece = pd.concat([kept, fresh.iloc[pos:end]], ignore_index=True).sort_values('date', kind='mergesort', ignore_index=True)
+        pos = end
+        for w in writers:
+            w.write(piece)
+    for w in writers:
+        if pos < len(fresh):
+            w.write(fresh.iloc[pos:].reset_index(drop=True))
+        w.close()
 
-ensure_dirs()
-raw_path = os.path.join(RAW_DIR, 'raw_history.csv')
-if not os.path.exists(raw_path):
-    raise SystemExit('No raw history found. Run generate_fake_data.py first.')
+def incremental(raw_manifest, watermark, opts):
+    dates = changed_dates(raw_manifest, watermark)
+    if not dates:
+        # Nothing to rebuild, but compaction may have moved dates to other partitions; record the new layout.
+        if watermark['partitions'] != raw_manifest['partitions']:
+            save_watermark(raw_manifest, watermark['dates'], watermark['weeks'], opts)
+        return 'incremental', 0, {}
+    # Re-read whole ISO weeks around every changed date so each period slice is complete.
+    mondays = sorted({d - pd.Timedelta(days=d.weekday()) for d in pd.to_datetime(sorted(dates))})
+    fresh = pd.concat([raw_store.read_history(start=m, end=m + pd.Timedelta(days=6), manifest=raw_manifest) for m in mondays], ignore_index=True)
+    fresh = derive(fresh)
+    keys = week_keys(dates) | present_weeks(fresh)
 
-df = pd.read_csv(raw_path)
-for col in ['market','account','brand','category','rep']:
-    df[col] = df[col].astype(str).str.strip()
+    processed_dates = watermark['dates']
+    processed = None
+    if opts.format == 'csv' and processed_dates and min(dates) > processed_dates[-1]:
+        fresh[fresh['date'] > pd.Timestamp(processed_dates[-1])].to_csv(tables.table_path(tables.PROCESSED, 'csv'), mode='a', header=False, index=False)
+    elif opts.chunk_rows:
+        streaming_splice(fresh.sort_values('date', kind='mergesort', ignore_index=True), keys, opts)
+    else:
+        existing = tables.read_table(tables.PROCESSED)
+        with step('process.splice') as s:
+            processed = splice(existing, fresh, keys, ['date'])
+            s.rows_in, s.rows_out = len(existing) + len(fresh), len(processed)
+        write_processed(processed, opts)
 
-df['date'] = pd.to_datetime(df['date'])
-df['gap_to_goal'] = df['goal'] - df['sales_volume']
-df['pct_attained'] = np.where(df['goal']>0, df['sales_volume']/df['goal'], np.nan)
+    cube_old = tables.read_table(tables.CUBE, aggregated=True)
+    with step('process.rollups', incremental=True) as s:
+        cube_new = rollups.build_cube(fresh)
+        cube = splice(cube_old, cube_new, keys, CUBE_KEYS)
+        removed = cube_old[in_weeks(cube_old, keys)]
+        rollup_tables = {}
+        for name, dims in rollups.ROLLUPS.items():
+            stem = tables.output(name)
+            if not tables.exists(stem, opts.format):
+                rollup_tables[name] = rollups.rollup(cube, dims)
+            elif rollups.is_weekly(dims):
+                rollup_tables[name] = splice(tables.read_table(stem, aggregated=True), rollups.rollup(cube_new, dims), keys, dims)
+            else:
+                rollup_tables[name] = rollups.apply_delta(tables.read_table(stem, aggregated=True), dims, cube_old, removed, cube_new)
+        # Features look back up to a year, so every period from the earliest rebuilt week on is refreshed.
+        stem = tables.output(features.NAME)
+        if tables.exists(stem, opts.format):
+            rollup_tables[features.NAME], feature_keys = features.update(tables.read_table(stem, aggregated=True), rollup_tables['account_summary'], min(keys))
+        else:
+            rollup_tables[features.NAME] = features.build(rollup_tables['account_summary'])
+            feature_keys = set(rollup_tables[features.NAME][PERIOD].unique().tolist())
+        s.rows_in, s.rows_out = len(fresh), len(cube)
+    write_outputs(cube, rollup_tables, opts)
+    if opts.sqlite:
+        sqlite_store.update(fresh, keys, rollup_tables, {features.NAME: feature_keys})
+    weeks = set(watermark['weeks']) - keys | present_weeks(fresh)
+    save_watermark(raw_manifest, set(processed_dates) - dates | date_strings(fresh), weeks, opts)
+    if processed is not None:
+        rollup_tables['processed'] = processed
+    return 'incremental', len(fresh), rollup_tables
 
-account_lift = df['account'].map({'Tom Thumb':0.08,'Kroger':0.10,'Central Market':0.07,'Whole Foods':0.06,'Market Street':0.09}).fillna(0.07)
-base_lift = 1.0 + account_lift * df['displays']
-df['expected_no_display'] = (df['sales_volume']/base_lift).round(0)
-df['uplift_estimate'] = (df['sales_volume'] - df['expected_no_display']).clip(lower=0)
+def outputs_exist(fmt):
+    return tables.exists(tables.PROCESSED, fmt) and tables.exists(tables.CUBE, fmt)
 
-df['week'] = df['date'].dt.isocalendar().week.astype(int)
-df['year'] = df['date'].dt.year.astype(int)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Derive processed rows and weekly rollups from the raw store.')
+    parser.add_argument('--full', action='store_true', help='Rebuild every output from the full history instead of only changed weeks.')
+    parser.add_argument('--format', choices=list(tables.FORMATS), default=tables.DEFAULT_FORMAT, help='Storage format for processed rows and rollups.')
+    parser.add_argument('--csv', action='store_true', help='Also export CSV copies of the processed rows and rollups.')
+    parser.add_argument('--sqlite', action='store_true', help='Also write processed rows and rollups to an indexed SQLite database the app queries instead of loading every table.')
+    parser.add_argument('--workers', type=int, default=1, help='Derive a full rebuild in this many processes, each taking a contiguous range of ISO weeks (ignored with --chunk-rows).')
+    parser.add_argument('--chunk-rows', type=int, default=None, help='Stream the history in chunks of about this many rows so peak memory does not grow with history.')
+    parser.add_argument('--verify', action='store_true', help='Afterwards rebuild everything from scratch in a temporary directory and check the outputs match.')
+    return parser.parse_args(argv)
 
-processed_path = os.path.join(PROCESSED_DIR, 'processed.csv')
-df.to_csv(processed_path, index=False)
+def run(args):
+    # Returns (mode, rows derived, frames): frames holds the rollups just written and, when it was
+    # materialized, the processed table, so callers in the same process need not read them back.
+    ensure_dirs()
+    with store_lock():
+        raw_manifest = raw_store.migrate_legacy()
+        if not raw_store.has_data(raw_manifest):
+            raise SystemExit('No raw history found. Run generate_fake_data.py first.')
 
-territory_summary = (df.groupby(['year','week','market']).agg(goal=('goal','sum'),sales=('sales_volume','sum'),displays=('displays','sum'),pods=('pods','sum'),voids=('voids','sum'),uplift=('uplift_estimate','sum')).reset_index())
-territory_summary['gap_to_goal'] = territory_summary['goal'] - territory_summary['sales']
-territory_summary['pct_attained'] = np.where(territory_summary['goal']>0, territory_summary['sales']/territory_summary['goal'], np.nan)
+        watermark = load_watermark()
+        in_sync = watermark is not None and (watermark.get('schema'), watermark.get('format'), watermark.get('sqlite', False)) == (SCHEMA_VERSION, args.format, args.sqlite)
+        if args.full or not in_sync or not outputs_exist(args.format) or (args.sqlite and not sqlite_store.exists()):
+            return (streaming_rebuild if args.chunk_rows else full_rebuild)(raw_manifest, args)
+        return incremental(raw_manifest, watermark, args)
 
-account_summary = (df.groupby(['year','week','market','account']).agg(goal=('goal','sum'),sales=('sales_volume','sum'),displays=('displays','sum'),pods=('pods','sum'),voids=('voids','sum'),uplift=('uplift_estimate','sum')).reset_index())
-account_summary['gap_to_goal'] = account_summary['goal'] - account_summary['sales']
-account_summary['pct_attained'] = np.where(account_summary['goal']>0, account_summary['sales']/account_summary['goal'], np.nan)
+def verify(args):
+    # Runs a plain full rebuild in a temporary tree that links to the live raw store and compares every file
+    # under PROCESSED_DIR and OUTPUTS_DIR: byte for byte, or by content for columnar tables written in batches
+    # and SQLite databases. Returns the live paths that differ.
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, os.path.dirname(RAW_DIR)))
+        os.symlink(os.path.abspath(RAW_DIR), os.path.join(tmp, RAW_DIR))
+        cmd = [sys.executable, os.path.abspath(__file__), '--full', '--format', args.format] + (['--csv'] if args.csv else []) + (['--sqlite'] if args.sqlite else [])
+        proc = subprocess.run(cmd, cwd=tmp, capture_output=True, text=True, env=dict(os.environ, CPWS_METRICS='0'))
+        if proc.returncode != 0:
+            raise SystemExit(f'Reference rebuild failed:\n{proc.stderr}')
+        mismatches = []
+        for d in (PROCESSED_DIR, OUTPUTS_DIR):
+            for name in sorted(set(os.listdir(d)) | set(os.listdir(os.path.join(tmp, d)))):
+                live, rebuilt = os.path.join(d, name), os.path.join(tmp, d, name)
+                if not (os.path.isfile(live) and os.path.isfile(rebuilt)):
+                    same = False
+                elif name.endswith('.sqlite'):
+                    same = sqlite_store.same_contents(live, rebuilt)
+                else:
+                    same = tables.same_contents(live, rebuilt)
+                if not same:
+                    mismatches.append(live)
+    return mismatches
 
-rep_scorecards = (df.groupby(['rep','market','account']).agg(goal=('goal','sum'),sales=('sales_volume','sum'),displays=('displays','sum'),pods=('pods','sum'),voids=('voids','sum'),uplift=('uplift_estimate','sum')).reset_index())
-rep_scorecards['gap_to_goal'] = rep_scorecards['goal'] - rep_scorecards['sales']
-rep_scorecards['pct_attained'] = np.where(rep_scorecards['goal']>0, rep_scorecards['sales']/rep_scorecards['goal'], np.nan)
+def main(argv=None):
+    args = parse_args(argv)
+    # The lock is held through verification so the store cannot change between the run and the rebuild.
+    with store_lock():
+        with step('process_data') as s:
+            mode, rows, _ = run(args)
+            s.rows_out, s.fields['mode'] = rows, mode
+        print(f'Processed & rollups saved ({mode}, {rows:,} rows derived).')
+        if args.verify:
+            mismatches = verify(args)
+            if mismatches:
+                raise SystemExit('Outputs differ from a full rebuild: ' + ', '.join(mismatches))
+            print('Verified: outputs match a full rebuild.')
 
-territory_summary.to_csv(os.path.join(OUTPUTS_DIR,'territory_summary.csv'), index=False)
-account_summary.to_csv(os.path.join(OUTPUTS_DIR,'account_summary.csv'), index=False)
-rep_scorecards.to_csv(os.path.join(OUTPUTS_DIR,'rep_scorecards.csv'), index=False)
-print('Processed & rollups saved.')
+if __name__ == '__main__':
+    main()
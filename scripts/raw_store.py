@@ -0,0 +1,259 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import validate
+from utils import RAW_DIR, RAW_STORE_DIR, RAW_COLUMNS, KEY_COLUMNS, apply_schema, file_checksum, read_json, write_json, step, store_lock
+
+# Raw history lives in zstd-compressed Parquet files under RAW_STORE_DIR: one per day (date=YYYY-MM-DD), and
+# one per month (month=YYYY-MM) once compact.py has merged a closed month; later rows for a compacted month
+# are written into its monthly file. manifest.json maps partition name -> {file, rows, dates, sha256}, plus
+# for monthly partitions 'days', a version per date that only changes when that date's rows do (see
+# date_versions). Only partitions being written are touched.
+MANIFEST_PATH = os.path.join(RAW_STORE_DIR, 'manifest.json')
+# key_index.npy holds one (hash, day, row) entry per stored row, sorted by the 64-bit hash of the dedup key, so
+# new rows are matched with a binary search instead of re-hashing every stored key. day identifies the
+# partition (partition_day) and row is the position within that partition.
+KEY_INDEX_PATH = os.path.join(RAW_STORE_DIR, 'key_index.npy')
+KEY_INDEX_DTYPE = np.dtype([('hash', '<u8'), ('day', '<i4'), ('row', '<i4')])
+LEGACY_HISTORY_PATH = os.path.join(RAW_DIR, 'raw_history.csv')
+
+def load_manifest():
+    return read_json(MANIFEST_PATH, {'partitions': {}})
+
+def save_manifest(manifest):
+    write_json(MANIFEST_PATH, manifest)
+
+def partition_name(date):
+    return f'date={pd.Timestamp(date):%Y-%m-%d}'
+
+def month_name(date):
+    return f'month={pd.Timestamp(date):%Y-%m}'
+
+def is_monthly(name):
+    return name.startswith('month=')
+
+def partition_day(name):
+    # Date ordinal of a daily partition, or of the first of the month for a monthly one.
+    value = name.split('=', 1)[1]
+    return pd.Timestamp(value + '-01' if is_monthly(name) else value).toordinal()
+
+def partition_for(date, parts):
+    return month_name(date) if month_name(date) in parts else partition_name(date)
+
+def date_versions(manifest):
+    # date -> version of its rows: the file checksum of a daily partition, or the version a monthly partition
+    # recorded for the date (carried over by compaction, so merging days into a month changes nothing here).
+    versions = {}
+    for entry in manifest['partitions'].values():
+        days = entry.get('days', {})
+        for d in entry['dates']:
+            versions[d] = days.get(d, entry['sha256'])
+    return versions
+
+def partition_path(entry):
+    return os.path.join(RAW_STORE_DIR, entry['file'])
+
+def read_partition(entry, columns=None):
+    return pd.read_parquet(partition_path(entry), columns=columns)
+
+def write_partition(name, df):
+    file = f'{name}.parquet'
+    path = os.path.join(RAW_STORE_DIR, file)
+    tmp = path + '.tmp'
+    df.to_parquet(tmp, engine='pyarrow', compression='zstd', index=False)
+    os.replace(tmp, path)
+    return {'file': file, 'rows': int(len(df)), 'dates': sorted(df['date'].dt.strftime('%Y-%m-%d').unique().tolist()), 'sha256': file_checksum(path)}
+
+def normalize(df):
+    df = df[RAW_COLUMNS].copy()
+    df['date'] = pd.to_datetime(df['date'])
+    return apply_schema(df)
+
+def key_hash(df):
+    keys = df[KEY_COLUMNS].copy()
+    keys['date'] = keys['date'].astype('datetime64[ns]')
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy()
+
+def save_key_index(index, manifest):
+    tmp = KEY_INDEX_PATH + '.tmp.npy'
+    np.save(tmp, index)
+    os.replace(tmp, KEY_INDEX_PATH)
+    manifest['key_index_rows'] = int(len(index))
+
+def index_entries(hashes, day, rows):
+    entries = np.empty(len(hashes), dtype=KEY_INDEX_DTYPE)
+    entries['hash'], entries['day'], entries['row'] = hashes, day, rows
+    return entries
+
+def build_key_index(manifest):
+    entries = []
+    for name, entry in partitions(manifest):
+        hashes = key_hash(read_partition(entry, KEY_COLUMNS))
+        entries.append(index_entries(hashes, partition_day(name), np.arange(len(hashes))))
+    index = np.concatenate(entries) if entries else np.empty(0, dtype=KEY_INDEX_DTYPE)
+    return index[np.argsort(index['hash'], kind='stable')]
+
+def load_key_index(manifest):
+    # Rebuilt from the partitions when missing or out of step with the manifest (e.g. after a manual edit).
+    if os.path.exists(KEY_INDEX_PATH):
+        index = np.load(KEY_INDEX_PATH)
+        if len(index) == manifest.get('key_index_rows', -1) == total_rows(manifest):
+            return index
+    return build_key_index(manifest)
+
+def last_per_key(hashes):
+    # Positions of the last occurrence of every hash, in their original order (drop_duplicates keep='last').
+    _, from_end = np.unique(hashes[::-1], return_index=True)
+    return np.sort(len(hashes) - 1 - from_end)
+
+def upsert(df, replace=False, manifest=None):
+    # Only the new rows are hashed. They are looked up in the sorted key index with one binary search each;
+    # a stored row with the same key is overwritten (keep='last', as within the batch), and replace=True
+    # swaps each touched day for the new rows outright. The index is rewritten by a single merge.
+    with store_lock():
+        manifest = manifest if manifest is not None else load_manifest()
+        return _upsert(df, replace, manifest)
+
+def _upsert(df, replace, manifest):
+    parts = manifest['partitions']
+    with step('raw.upsert') as s:
+        df = normalize(df)
+        rows_in = len(df)
+        index = load_key_index(manifest)
+        hashes = key_hash(df)
+        keep = last_per_key(hashes)
+        df, hashes = df.iloc[keep].reset_index(drop=True), hashes[keep]
+        groups = {}
+        for date, rows in sorted(df.groupby('date').indices.items()):
+            groups.setdefault(partition_for(date, parts), []).append(rows)
+
+        pos = np.minimum(np.searchsorted(index['hash'], hashes), max(len(index) - 1, 0))
+        hit = (index['hash'][pos] == hashes) if len(index) else np.zeros(len(hashes), dtype=bool)
+        stale = np.zeros(len(index), dtype=bool)
+        stale[pos[hit]] = True
+        # Partitions losing stored rows get their surviving entries renumbered; the scan over the index is only
+        # needed when something is actually overwritten or replaced. Monthly partitions are re-sorted by date
+        # whenever they are written, so they are always renumbered.
+        renumber = set(index['day'][pos[hit]].tolist())
+        renumber |= {partition_day(name) for name in groups if name in parts and (replace or is_monthly(name))}
+        touched = np.isin(index['day'], list(renumber)) if renumber else np.zeros(len(index), dtype=bool)
+        entries, entry_stale = index[touched], stale[touched]
+
+        written, rows_out, additions, overwrites = [], 0, [], 0
+        for name, rows in sorted(groups.items()):
+            rows = np.concatenate(rows)
+            day, new = partition_day(name), df.iloc[rows]
+            part_hashes, offset = hashes[rows], 0
+            if name in parts and replace and not is_monthly(name):
+                overwrites += parts[name]['rows']
+            elif name in parts:
+                existing = read_partition(parts[name])
+                s.read(partition_path(parts[name]))
+                if day in renumber:
+                    # Survivors are re-added ahead of the new rows; a monthly partition keeps the days not replaced.
+                    mine = entries['day'] == day
+                    order = np.argsort(entries['row'][mine])
+                    kept = ~entry_stale[mine][order]
+                    if replace:
+                        kept &= ~existing['date'].isin(new['date'].unique()).to_numpy()
+                    existing = existing.iloc[np.flatnonzero(kept)]
+                    part_hashes = np.concatenate([entries['hash'][mine][order][kept], part_hashes])
+                    overwrites += int((~kept).sum())
+                else:
+                    offset = len(existing)
+                new = pd.concat([existing, new], ignore_index=True)
+            if is_monthly(name):
+                # Stable, so each day's rows keep the order a daily partition would have.
+                order = np.argsort(new['date'].to_numpy(), kind='stable')
+                new, part_hashes = new.iloc[order].reset_index(drop=True), part_hashes[order]
+            additions.append(index_entries(part_hashes, day, offset + np.arange(len(part_hashes))))
+            previous = parts.get(name, {})
+            parts[name] = write_partition(name, new)
+            if is_monthly(name):
+                changed = set(df['date'].iloc[rows].dt.strftime('%Y-%m-%d'))
+                versions = previous.get('days', {})
+                parts[name]['days'] = {d: versions[d] if d in versions and d not in changed else parts[name]['sha256'] for d in parts[name]['dates']}
+            s.wrote(partition_path(parts[name]))
+            written.append(name)
+            rows_out += len(new)
+
+        index = index[~touched] if renumber else index
+        added = np.concatenate(additions) if additions else np.empty(0, dtype=KEY_INDEX_DTYPE)
+        added = added[np.argsort(added['hash'], kind='stable')]
+        index = np.insert(index, np.searchsorted(index['hash'], added['hash']), added)
+        save_key_index(index, manifest)
+        save_manifest(manifest)
+        stats = {'partitions_written': written, 'rows_in': rows_in, 'rows_out': rows_out, 'duplicates': rows_in - len(df), 'overwrites': overwrites, 'inserted': int((~hit).sum())}
+        s.rows_in, s.rows_out = rows_in, rows_out
+        s.fields.update(duplicates=stats['duplicates'], overwrites=stats['overwrites'])
+    return stats
+
+def partitions(manifest=None, start=None, end=None):
+    manifest = manifest if manifest is not None else load_manifest()
+    start = pd.Timestamp(start).strftime('%Y-%m-%d') if start is not None else None
+    end = pd.Timestamp(end).strftime('%Y-%m-%d') if end is not None else None
+    parts = manifest['partitions']
+    # In date order; monthly and daily partitions never share a date.
+    for name in sorted(parts, key=lambda n: (parts[n]['dates'][0], n)):
+        entry = parts[name]
+        if start is not None and entry['dates'][-1] < start:
+            continue
+        if end is not None and entry['dates'][0] > end:
+            continue
+        yield name, entry
+
+def read_history(columns=None, start=None, end=None, manifest=None):
+    ranged = start is not None or end is not None
+    read_cols = columns if columns is None or 'date' in columns or not ranged else ['date'] + list(columns)
+    with step('raw.read_history') as s:
+        entries = [entry for _, entry in partitions(manifest, start, end)]
+        s.read(*[partition_path(e) for e in entries])
+        frames = [read_partition(entry, read_cols) for entry in entries]
+        if not frames:
+            return pd.DataFrame(columns=columns or RAW_COLUMNS)
+        df = apply_schema(pd.concat(frames, ignore_index=True))
+        s.rows_out = len(df)
+    if ranged:
+        mask = pd.Series(True, index=df.index)
+        if start is not None:
+            mask &= df['date'] >= pd.Timestamp(start)
+        if end is not None:
+            mask &= df['date'] <= pd.Timestamp(end)
+        df = df.loc[mask, columns or df.columns].reset_index(drop=True)
+    return df
+
+def iter_chunks(chunk_rows, columns=None, manifest=None):
+    # Yields the history in date order, roughly chunk_rows rows at a time, without materializing it.
+    buf, n = [], 0
+    for _, entry in partitions(manifest):
+        for batch in pq.ParquetFile(partition_path(entry)).iter_batches(batch_size=chunk_rows, columns=columns):
+            buf.append(batch.to_pandas())
+            n += batch.num_rows
+            if n >= chunk_rows:
+                yield apply_schema(pd.concat(buf, ignore_index=True))
+                buf, n = [], 0
+    if buf:
+        yield apply_schema(pd.concat(buf, ignore_index=True))
+
+def total_rows(manifest=None):
+    manifest = manifest if manifest is not None else load_manifest()
+    return sum(e['rows'] for e in manifest['partitions'].values())
+
+def has_data(manifest=None):
+    manifest = manifest if manifest is not None else load_manifest()
+    return bool(manifest['partitions'])
+
+def migrate_legacy():
+    # One-time import of the pre-partitioning raw_history.csv; the CSV is left in place.
+    with store_lock():
+        manifest = load_manifest()
+        if manifest.get('legacy_imported') or not os.path.exists(LEGACY_HISTORY_PATH):
+            return manifest
+        if not manifest['partitions']:
+            df, quality = validate.run({LEGACY_HISTORY_PATH: validate.read_drop(LEGACY_HISTORY_PATH)})
+            print('Legacy import ' + validate.describe(quality))
+            upsert(df, manifest=manifest)
+        manifest['legacy_imported'] = True
+        save_manifest(manifest)
+        return manifest
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+from periods import PERIOD
+
+# Every rollup is a sum over the same metrics, so the data is aggregated once at the finest grain
+# (the cube) and each rollup is derived from the cube. New rollups only need a dimension list here.
+CUBE_KEYS = [PERIOD,'market','account','rep','brand','category']
+METRICS = ['goal','sales','displays','pods','voids','uplift']
+COUNT_METRICS = ['goal','sales','displays','pods','voids']
+AGGS = dict(goal=('goal','sum'),sales=('sales_volume','sum'),displays=('displays','sum'),pods=('pods','sum'),voids=('voids','sum'),uplift=('uplift_estimate','sum'))
+
+ROLLUPS = {
+    'territory_summary': [PERIOD,'market'],
+    'account_summary': [PERIOD,'market','account'],
+    'rep_scorecards': ['rep','market','account'],
+    'brand_summary': [PERIOD,'market','brand'],
+    'category_summary': [PERIOD,'market','category'],
+}
+
+def finish(summary):
+    summary['gap_to_goal'] = summary['goal'] - summary['sales']
+    summary['pct_attained'] = np.where(summary['goal']>0, summary['sales']/summary['goal'], np.nan)
+    return summary
+
+def build_cube(df):
+    # Grouped sums keep the compact row-level int dtypes; widen once here so every rollup sums in int64.
+    cube = df.groupby(CUBE_KEYS, observed=True).agg(rows=('goal','size'), **AGGS).reset_index()
+    return cube.astype({m: 'int64' for m in COUNT_METRICS})
+
+def combine(cubes):
+    # Partial cubes from separate chunks are mergeable: re-sum any cells they share.
+    cube = pd.concat([c for c in cubes if c is not None], ignore_index=True)
+    cube = cube.groupby(CUBE_KEYS, observed=True)[['rows'] + METRICS].sum().reset_index()
+    return cube.astype({m: 'int64' for m in ['rows'] + COUNT_METRICS})
+
+def with_year_week(summary):
+    # Weekly rollups are keyed (and sorted) by period; ISO year and week are kept alongside for display.
+    if PERIOD in summary and 'year' not in summary:
+        summary.insert(1, 'year', (summary[PERIOD] // 100).astype('int16'))
+        summary.insert(2, 'week', (summary[PERIOD] % 100).astype('int16'))
+    return summary
+
+def rollup(cube, dims):
+    return with_year_week(finish(cube.groupby(dims, observed=True)[METRICS].sum().reset_index()))
+
+def rollup_all(cube, rollups=None):
+    return {name: rollup(cube, dims) for name, dims in (rollups or ROLLUPS).items()}
+
+def is_weekly(dims):
+    return PERIOD in dims
+
+def apply_delta(existing, dims, cube_old, removed, added):
+    # Additive update for rollups that span all weeks: existing - removed slices + added slices.
+    cols = ['rows'] + METRICS
+    table = existing.set_index(dims)
+    table['rows'] = cube_old.groupby(dims, observed=True)['rows'].sum()
+    table = table[cols].sub(removed.groupby(dims, observed=True)[cols].sum(), fill_value=0)
+    table = table.add(added.groupby(dims, observed=True)[cols].sum(), fill_value=0)
+    table = table[table['rows'] > 0].sort_index().reset_index()
+    for col in COUNT_METRICS:
+        table[col] = table[col].astype('int64')
+    return finish(table.drop(columns='rows'))
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import raw_store
+import tables
+import process_data
+import features
+import build_dashboard
+import generate_weekly_recap
+import generate_fake_data
+from utils import DATA_DIR, ensure_dirs, file_checksum, read_json, write_json, step
+
+# Runs the daily job in one process: generate -> process -> (dashboard, recap). Frames produced by one stage
+# are handed to the next in memory, and each stage is skipped when the content hash of its inputs matches
+# the hash recorded in STATE_PATH for its last successful run and its outputs are still there.
+STATE_PATH = os.path.join(DATA_DIR, 'pipeline_state.json')
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ['generate', 'process', 'dashboard', 'recap']
+
+def digest(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def code_hash(*modules):
+    # A stage also reruns when its own code changes.
+    return [file_checksum(os.path.join(SCRIPTS_DIR, f'{m}.py')) for m in modules]
+
+def processed_hash():
+    # The processed watermark records the raw partitions the outputs were derived from (and the format), so
+    # their per-date versions identify the processed table and rollups without re-reading them.
+    watermark = process_data.load_watermark()
+    return watermark and {'dates': raw_store.date_versions(watermark), 'format': watermark['format']}
+
+class Context:
+    # Frames shared between stages. Anything a stage did not hand over is read from disk once, on first use.
+    def __init__(self):
+        self.frames = {}
+        self.lock = threading.Lock()
+
+    def processed(self):
+        with self.lock:
+            if 'processed' not in self.frames:
+                self.frames['processed'] = tables.read_table(tables.PROCESSED, columns=build_dashboard.PROCESSED_COLUMNS)
+            return self.frames['processed']
+
+    def rollup(self, name):
+        with self.lock:
+            if name not in self.frames:
+                self.frames[name] = tables.read_table(tables.output(name), aggregated=True)
+            return self.frames[name]
+
+def generate_inputs(args):
+    dates = [d.isoformat() for d in generate_fake_data.date_range(args.days, args.start)]
+    return digest(dates, args.rows_per_day, args.seed, args.force_days, code_hash('generate_fake_data', 'validate'))
+
+def run_generate(args, ctx):
+    argv = ['--days', str(args.days), '--rows-per-day', str(args.rows_per_day), '--seed', str(args.seed), '--workers', str(args.workers)]
+    argv += ['--start', args.start] if args.start else []
+    argv += ['--force'] if args.force_days else []
+    generate_fake_data.main(argv)
+    return [raw_store.MANIFEST_PATH]
+
+def process_inputs(args):
+    manifest = raw_store.load_manifest()
+    return digest(raw_store.date_versions(manifest), args.format, args.csv, args.sqlite, args.full, code_hash('process_data', 'rollups', 'features', 'periods', 'raw_store', 'sqlite_store', 'tables', 'utils'))
+
+def run_process(args, ctx):
+    opts = process_data.parse_args(['--format', args.format] + (['--csv'] if args.csv else []) + (['--sqlite'] if args.sqlite else []) + (['--full'] if args.full else []) + ['--workers', str(args.workers)] + (['--chunk-rows', str(args.chunk_rows)] if args.chunk_rows else []))
+    mode, rows, frames = process_data.run(opts)
+    ctx.frames.update(frames)
+    print(f'Processed & rollups saved ({mode}, {rows:,} rows derived).')
+    return [process_data.WATERMARK_PATH]
+
+def dashboard_inputs(args):
+    return digest(processed_hash(), code_hash('build_dashboard', 'periods'))
+
+def run_dashboard(args, ctx):
+    path = build_dashboard.build(ctx.processed(), ctx.rollup('territory_summary'), ctx.rollup('account_summary'), ctx.rollup(features.NAME))
+    print('Wrote', path)
+    return [path]
+
+def recap_inputs(args):
+    return digest(processed_hash(), code_hash('generate_weekly_recap', 'periods'))
+
+def run_recap(args, ctx):
+    written, skipped = generate_weekly_recap.build(ctx.rollup('territory_summary'), ctx.rollup(features.NAME))
+    for path in written:
+        print('Wrote', path)
+    return written + skipped
+
+# name -> (upstream stages, input hash, runner)
+DAG = {
+    'generate': ([], generate_inputs, run_generate),
+    'process': (['generate'], process_inputs, run_process),
+    'dashboard': (['process'], dashboard_inputs, run_dashboard),
+    'recap': (['process'], recap_inputs, run_recap),
+}
+
+def run_stage(name, args, ctx, state):
+    _, inputs, runner = DAG[name]
+    key = inputs(args)
+    last = state.get(name)
+    if not args.force and last and last['inputs'] == key and all(os.path.exists(p) for p in last['outputs']):
+        print(f'[{name}] skipped (inputs unchanged)')
+        return
+    t0 = time.perf_counter()
+    with step(f'pipeline.{name}'):
+        outputs = runner(args, ctx)
+    elapsed = time.perf_counter() - t0
+    # Downstream stages hash what this stage wrote, so record the post-run input hash.
+    state[name] = {'inputs': inputs(args), 'outputs': outputs, 'seconds': round(elapsed, 3), 'finished': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    print(f'[{name}] done in {elapsed:.2f}s')
+
+def levels(stages):
+    # Group the selected stages into waves whose upstream stages all ran in an earlier wave.
+    done, waves = set(), []
+    remaining = [s for s in STAGES if s in stages]
+    while remaining:
+        wave = [s for s in remaining if all(d in done or d not in stages for d in DAG[s][0])]
+        waves.append(wave)
+        done.update(wave)
+        remaining = [s for s in remaining if s not in done]
+    return waves
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run generate, process, dashboard and recap as one job, skipping stages whose inputs are unchanged.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=None, help='Stages to run (default: all; generate only when --days is given).')
+    parser.add_argument('--force', action='store_true', help='Run every selected stage even if its inputs are unchanged.')
+    parser.add_argument('--days', type=int, default=None, help='Generate this many days of simulated data first.')
+    parser.add_argument('--start', type=str, default=None, help='Start date YYYY-MM-DD for generated days.')
+    parser.add_argument('--force-days', action='store_true', help='Overwrite generated days that already exist.')
+    parser.add_argument('--rows-per-day', type=int, default=800, help='Rows generated per day.')
+    parser.add_argument('--seed', type=int, default=42, help='Generator base seed.')
+    parser.add_argument('--workers', type=int, default=1, help='Process pool size for generating days and for full processing rebuilds.')
+    parser.add_argument('--full', action='store_true', help='Rebuild processed outputs from the full history.')
+    parser.add_argument('--format', choices=list(tables.FORMATS), default=tables.DEFAULT_FORMAT, help='Storage format for processed rows and rollups.')
+    parser.add_argument('--csv', action='store_true', help='Also export CSV copies of the processed rows and rollups.')
+    parser.add_argument('--sqlite', action='store_true', help='Also write the processed rows and rollups to the SQLite store.')
+    parser.add_argument('--chunk-rows', type=int, default=None, help='Process the history in chunks of about this many rows.')
+    args = parser.parse_args(argv)
+
+    stages = args.stages or [s for s in STAGES if s != 'generate' or args.days]
+    if 'generate' in stages and not args.days:
+        parser.error('--days is required to run the generate stage')
+
+    ensure_dirs()
+    state, ctx = read_json(STATE_PATH, {}), Context()
+    t0 = time.perf_counter()
+    for wave in levels(stages):
+        if len(wave) == 1:
+            run_stage(wave[0], args, ctx, state)
+        else:
+            with ThreadPoolExecutor(max_workers=len(wave)) as pool:
+                for f in [pool.submit(run_stage, s, args, ctx, state) for s in wave]:
+                    f.result()
+        write_json(STATE_PATH, state)
+    print(f'Pipeline finished in {time.perf_counter() - t0:.2f}s')
+
+if __name__ == '__main__':
+    main()
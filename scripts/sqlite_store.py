@@ -0,0 +1,192 @@
+import os
+import sqlite3
+import hashlib
+import pandas as pd
+from periods import PERIOD
+from utils import PROCESSED_DIR, apply_schema, step
+
+# Optional SQLite copy of the processed rows and rollups (process_data.py --sqlite), for readers that should
+# pull only the rows they need instead of holding whole tables in memory. Besides the processed rows and
+# rollups it keeps 'daily', the per date/market/account totals the app charts. Every table is indexed on
+# whichever of INDEX_COLUMNS it has. Rebuilds write a new file and swap it in; incremental runs replace
+# the rows of the rebuilt periods in one transaction.
+DB_PATH = os.path.join(PROCESSED_DIR, 'cpws.sqlite')
+INDEX_COLUMNS = [PERIOD, 'market', 'account', 'rep']
+DAILY = 'daily'
+DAILY_KEYS = [PERIOD, 'date', 'market', 'account']
+DAILY_METRICS = ['goal','sales_volume']
+INSERT_ROWS = 50_000
+
+def exists(path=DB_PATH):
+    return os.path.exists(path)
+
+def drop(path=DB_PATH):
+    if os.path.exists(path):
+        os.remove(path)
+
+def version(path=DB_PATH):
+    st = os.stat(path)
+    return 'sqlite-' + hashlib.sha1(repr((st.st_mtime_ns, st.st_size)).encode()).hexdigest()[:12]
+
+def connect(path=DB_PATH, readonly=False):
+    if readonly:
+        return sqlite3.connect(f'file:{path}?mode=ro', uri=True, timeout=30)
+    return sqlite3.connect(path, timeout=30)
+
+def daily_totals(df):
+    return df.groupby(DAILY_KEYS, observed=True)[DAILY_METRICS].sum().reset_index()
+
+def fill_daily(con):
+    # The same totals as daily_totals, computed over the whole processed table inside SQLite.
+    types = {row[1]: row[2] for row in con.execute('PRAGMA table_info("processed")')}
+    cols = DAILY_KEYS + DAILY_METRICS
+    keys = ', '.join(f'"{c}"' for c in DAILY_KEYS)
+    con.execute(f'CREATE TABLE "{DAILY}" (' + ', '.join(f'"{c}" {types[c]}' for c in cols) + ')')
+    con.execute(f'INSERT INTO "{DAILY}" SELECT {keys}, ' + ', '.join(f'SUM("{c}")' for c in DAILY_METRICS) + f' FROM "processed" GROUP BY {keys} ORDER BY {keys}')
+
+def sql_type(dtype):
+    if pd.api.types.is_integer_dtype(dtype):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(dtype):
+        return 'REAL'
+    return 'TEXT'
+
+def values(s):
+    # Dates are stored as ISO text, categoricals as their labels; NaN becomes NULL.
+    if pd.api.types.is_datetime64_any_dtype(s):
+        return s.to_numpy().astype('datetime64[D]').astype(str).tolist()
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        return s.astype(object).where(s.notna(), None).tolist()
+    return s.tolist()
+
+def insert(con, name, df):
+    cols = ', '.join(f'"{c}"' for c in df.columns)
+    con.execute(f'CREATE TABLE IF NOT EXISTS "{name}" (' + ', '.join(f'"{c}" {sql_type(df[c].dtype)}' for c in df.columns) + ')')
+    sql = f'INSERT INTO "{name}" ({cols}) VALUES ({", ".join("?" * len(df.columns))})'
+    for start in range(0, len(df), INSERT_ROWS):
+        chunk = df.iloc[start:start + INSERT_ROWS]
+        con.executemany(sql, zip(*[values(chunk[c]) for c in df.columns]))
+
+def create_indexes(con):
+    for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+        present = {row[1] for row in con.execute(f'PRAGMA table_info("{name}")')}
+        cols = [c for c in INDEX_COLUMNS if c in present]
+        if cols:
+            con.execute(f'CREATE INDEX IF NOT EXISTS "ix_{name}" ON "{name}" (' + ', '.join(f'"{c}"' for c in cols) + ')')
+
+class Writer:
+    # Builds a fresh database next to the live one, processed rows chunk by chunk, and swaps it into
+    # place on close() together with the rollups. 'daily' is filled once on close(), since a day's rows
+    # may span chunks.
+    def __init__(self, path=DB_PATH):
+        self.path, self.tmp = path, path + '.tmp'
+        if os.path.exists(self.tmp):
+            os.remove(self.tmp)
+        self.con = connect(self.tmp)
+        self.rows = 0
+
+    def write(self, df):
+        with step('sqlite.insert') as s:
+            insert(self.con, 'processed', df)
+            s.rows_in = len(df)
+        self.rows += len(df)
+
+    def close(self, rollup_tables):
+        with step('sqlite.write', rebuild=True) as s:
+            if self.rows:
+                fill_daily(self.con)
+            for name, table in rollup_tables.items():
+                insert(self.con, name, table)
+            create_indexes(self.con)
+            self.con.commit()
+            self.con.close()
+            os.replace(self.tmp, self.path)
+            s.rows_in = self.rows
+            s.wrote(self.path)
+        return self.path
+
+def update(fresh, keys, rollup_tables, replaced=None, path=DB_PATH):
+    # Incremental counterpart of Writer: processed, daily and weekly rollup rows of the rebuilt periods are
+    # deleted through the period index and re-inserted; rollups without a period are small and replaced whole.
+    # replaced maps a table to its own set of rebuilt periods when that differs from keys.
+    keys = sorted(int(k) for k in keys)
+    replaced = {name: sorted(int(k) for k in ks) for name, ks in (replaced or {}).items()}
+    with step('sqlite.write', incremental=True) as s:
+        con = connect(path)
+        try:
+            with con:
+                present = {name for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+                for name in present & ({'processed', DAILY} | {n for n, t in rollup_tables.items() if PERIOD in t}):
+                    con.executemany(f'DELETE FROM "{name}" WHERE "{PERIOD}" = ?', [(k,) for k in replaced.get(name, keys)])
+                insert(con, 'processed', fresh)
+                insert(con, DAILY, daily_totals(fresh))
+                for name, table in rollup_tables.items():
+                    if PERIOD in table and name in present:
+                        insert(con, name, table[table[PERIOD].isin(replaced.get(name, keys))])
+                    else:
+                        con.execute(f'DROP TABLE IF EXISTS "{name}"')
+                        insert(con, name, table)
+                create_indexes(con)
+        finally:
+            con.close()
+        s.rows_in = len(fresh)
+        s.wrote(path)
+    return path
+
+def same_contents(path, other):
+    # Row-level comparison of two databases: an incremental update and a rebuild store the same rows in a
+    # different order and file layout.
+    a, b = connect(path, readonly=True), connect(other, readonly=True)
+    try:
+        names = [sorted(name for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")) for con in (a, b)]
+        if names[0] != names[1]:
+            return False
+        for name in names[0]:
+            info = f'PRAGMA table_info("{name}")'
+            rows = f'SELECT * FROM "{name}"'
+            if a.execute(info).fetchall() != b.execute(info).fetchall() or sorted(map(repr, a.execute(rows))) != sorted(map(repr, b.execute(rows))):
+                return False
+        return True
+    finally:
+        a.close()
+        b.close()
+
+def where(period=None, **columns):
+    # WHERE clause and parameters for an optional period and an IN list per column; None skips a column
+    # and an empty list matches nothing.
+    clauses, params = [], []
+    if period is not None:
+        clauses.append(f'"{PERIOD}" = ?')
+        params.append(int(period))
+    for col, vals in columns.items():
+        if vals is not None:
+            clauses.append(f'"{col}" IN (' + ', '.join('?' * len(vals)) + ')')
+            params.extend(vals)
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+def query(sql, params=(), aggregated=False, path=DB_PATH):
+    with step('sqlite.query') as s:
+        con = connect(path, readonly=True)
+        try:
+            df = pd.read_sql_query(sql, con, params=list(params))
+        finally:
+            con.close()
+        if 'date' in df:
+            df['date'] = pd.to_datetime(df['date'])
+        df = apply_schema(df, metrics=not aggregated)
+        s.rows_out = len(df)
+    return df
+
+def table_names(path=DB_PATH):
+    con = connect(path, readonly=True)
+    try:
+        return {name for (name,) in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    finally:
+        con.close()
+
+def distinct(table, col, path=DB_PATH):
+    con = connect(path, readonly=True)
+    try:
+        return [v for (v,) in con.execute(f'SELECT DISTINCT "{col}" FROM "{table}" ORDER BY "{col}"')]
+    finally:
+        con.close()
@@ -0,0 +1,182 @@
+import io
+import os
+import filecmp
+import hashlib
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
+from utils import PROCESSED_DIR, OUTPUTS_DIR, METRIC_DTYPES, apply_schema, read_typed_csv, step
+
+# Processed rows and rollups are stored once in a typed columnar format. Feather (uncompressed Arrow IPC)
+# is the default because it can be memory-mapped and read column by column; Parquet trades that for size.
+# CSV remains available both as a primary format and as an export copy next to the columnar file.
+FORMATS = {'feather': '.feather', 'parquet': '.parquet', 'csv': '.csv'}
+DEFAULT_FORMAT = 'feather'
+
+PROCESSED = os.path.join(PROCESSED_DIR, 'processed')
+CUBE = os.path.join(PROCESSED_DIR, 'cube')
+
+def output(name):
+    return os.path.join(OUTPUTS_DIR, name)
+
+def table_path(stem, fmt):
+    return stem + FORMATS[fmt]
+
+def find_table(stem):
+    for fmt in FORMATS:
+        path = table_path(stem, fmt)
+        if os.path.exists(path):
+            return path, fmt
+    return None, None
+
+def exists(stem, fmt=None):
+    return os.path.exists(table_path(stem, fmt)) if fmt else find_table(stem)[0] is not None
+
+def drop_other_formats(stem, fmt):
+    # Drop copies in other formats so readers never pick up a stale table.
+    for other in FORMATS:
+        if other != fmt and os.path.exists(table_path(stem, other)):
+            os.remove(table_path(stem, other))
+
+def write_table(df, stem, fmt=DEFAULT_FORMAT):
+    path = table_path(stem, fmt)
+    tmp = path + '.tmp'
+    with step('write_table', table=os.path.basename(path)) as s:
+        if fmt == 'feather':
+            df.to_feather(tmp, compression='uncompressed')
+        elif fmt == 'parquet':
+            df.to_parquet(tmp, engine='pyarrow', compression='zstd', index=False)
+        else:
+            df.to_csv(tmp, index=False)
+        os.replace(tmp, path)
+        drop_other_formats(stem, fmt)
+        s.rows_in = len(df)
+        s.wrote(path)
+    return path
+
+class TableWriter:
+    # Writes a table chunk by chunk (Arrow IPC record batches, Parquet row groups or CSV appends) and
+    # swaps it into place on close(), so only one chunk has to be in memory at a time.
+    def __init__(self, stem, fmt=DEFAULT_FORMAT, export=False):
+        self.stem, self.fmt, self.export = stem, fmt, export
+        self.path = table_path(stem, fmt)
+        self.tmp = self.path + '.tmp'
+        self.writer, self.schema, self.rows = None, None, 0
+
+    def write(self, df):
+        if self.fmt == 'csv':
+            df.to_csv(self.tmp, mode='a' if self.rows else 'w', header=not self.rows, index=False)
+        else:
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            if self.writer is None:
+                self.schema = table.schema
+                self.writer = pa.ipc.new_file(self.tmp, self.schema) if self.fmt == 'feather' else pq.ParquetWriter(self.tmp, self.schema, compression='zstd')
+            self.writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self):
+        with step('write_table', table=os.path.basename(self.path), streamed=True) as s:
+            if self.writer is not None:
+                self.writer.close()
+            os.replace(self.tmp, self.path)
+            if not self.export:
+                drop_other_formats(self.stem, self.fmt)
+            s.rows_in = self.rows
+            s.wrote(self.path)
+        return self.path
+
+def export_csv(df, stem):
+    path = table_path(stem, 'csv')
+    with step('export_csv', table=os.path.basename(path)) as s:
+        df.to_csv(path, index=False)
+        s.rows_in = len(df)
+        s.wrote(path)
+
+# Download formats: label -> (file extension, mime type).
+EXPORT_FORMATS = {'CSV': ('.csv', 'text/csv'), 'CSV (gzip)': ('.csv.gz', 'application/gzip'), 'Parquet': ('.parquet', 'application/octet-stream')}
+
+def export_bytes(df, fmt):
+    buf = io.BytesIO()
+    if fmt == 'Parquet':
+        df.to_parquet(buf, engine='pyarrow', compression='zstd', index=False)
+    else:
+        df.to_csv(buf, index=False, compression='gzip' if fmt == 'CSV (gzip)' else None)
+    return buf.getvalue()
+
+def read_table(stem, columns=None, aggregated=False):
+    path, fmt = find_table(stem)
+    if path is None:
+        raise FileNotFoundError(stem)
+    with step('read_table', table=os.path.basename(path)) as s:
+        if fmt == 'feather':
+            # Memory-mapped: only the selected columns' buffers are actually read.
+            table = feather.read_table(path, columns=columns, memory_map=True)
+            s.bytes_read = table.nbytes
+            df = apply_schema(table.to_pandas(), metrics=not aggregated)
+        elif fmt == 'parquet':
+            s.read(path)
+            df = apply_schema(pd.read_parquet(path, columns=columns), metrics=not aggregated)
+        else:
+            s.read(path)
+            dates = ['date'] if not aggregated and (columns is None or 'date' in columns) else []
+            df = read_typed_csv(path, parse_dates=dates, aggregated=aggregated, usecols=columns)
+        s.rows_out = len(df)
+    return df
+
+def same_contents(path, other):
+    # Feather and Parquet files written batch by batch differ in bytes from one written whole, not in content.
+    if filecmp.cmp(path, other, shallow=False):
+        return True
+    read = {'.feather': feather.read_table, '.parquet': pq.read_table}.get(os.path.splitext(path)[1])
+    return read is not None and read(path).equals(read(other))
+
+def iter_table(stem, chunk_rows, columns=None, aggregated=False):
+    path, fmt = find_table(stem)
+    if fmt == 'feather':
+        reader = pa.ipc.open_file(pa.memory_map(path))
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            yield apply_schema(pa.Table.from_batches([batch.select(columns) if columns else batch]).to_pandas(), metrics=not aggregated)
+    elif fmt == 'parquet':
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=columns):
+            yield apply_schema(batch.to_pandas(), metrics=not aggregated)
+    else:
+        for chunk in pd.read_csv(path, dtype=None if aggregated else METRIC_DTYPES, float_precision='round_trip', chunksize=chunk_rows, usecols=columns):
+            if 'date' in chunk:
+                chunk['date'] = pd.to_datetime(chunk['date'])
+            yield apply_schema(chunk, metrics=not aggregated)
+
+def signature(stem):
+    path, _ = find_table(stem)
+    if path is None:
+        return None
+    st = os.stat(path)
+    return (path, st.st_mtime_ns, st.st_size)
+
+class TableCache:
+    # Process-wide handle on loaded tables. refresh() stats the files and reloads only the tables whose
+    # signature changed; version identifies the current combination so callers can key memoized results on it.
+    def __init__(self, specs):
+        self.specs = specs
+        self.frames, self.signatures = {}, {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        with self.lock:
+            changed = set()
+            for name, (stem, load) in self.specs.items():
+                sig = signature(stem)
+                if name in self.frames and sig == self.signatures.get(name):
+                    continue
+                self.frames[name] = load(stem) if sig else None
+                self.signatures[name] = sig
+                changed.add(name)
+            if changed:
+                self.version = hashlib.sha1(repr(sorted(self.signatures.items())).encode()).hexdigest()[:12]
+            return changed
+
+    def __getitem__(self, name):
+        return self.frames[name]
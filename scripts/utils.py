@@ -1,11 +1,24 @@
 
 import os
+import json
+import time
+import hashlib
+import cProfile
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
 
 DATA_DIR = os.path.join('data')
 RAW_DIR = os.path.join(DATA_DIR, 'raw')
+RAW_STORE_DIR = os.path.join(RAW_DIR, 'store')
+SPOOL_DIR = os.path.join(RAW_DIR, 'spool')
 PROCESSED_DIR = os.path.join(DATA_DIR, 'processed')
 OUTPUTS_DIR = os.path.join(DATA_DIR, 'outputs')
+QUARANTINE_DIR = os.path.join(DATA_DIR, 'quarantine')
+METRICS_PATH = os.path.join(DATA_DIR, 'metrics.jsonl')
+LOCK_PATH = os.path.join(DATA_DIR, 'store.lock')
 DOCS_DIR = os.path.join('docs')
 RECAPS_DIR = os.path.join(DOCS_DIR, 'weekly_recaps')
 
@@ -15,6 +28,186 @@ BRANDS = ['Estate Ridge Cabernet', 'Lone Star Vodka', 'Hill Country IPA', 'Gulf
 REPS = ['Alex Carter', 'Jordan Lee', 'Taylor Morgan', 'Sam Nguyen', 'Riley Brooks', 'Casey Diaz', 'Jamie Patel', 'Drew Kim']
 CATEGORIES = ['Wine', 'Spirits', 'Beer']
 
+RAW_COLUMNS = ['date','market','account','brand','category','rep','goal','sales_volume','displays','pods','voids']
+KEY_COLUMNS = ['date','market','account','brand','rep']
+
+# Shared in-memory schema: dimension columns are categoricals over the fixed vocabularies above
+# (sorted, so categorical order matches plain string order), metrics are downcast ints.
+DIMENSIONS = {'market': MARKETS, 'account': ACCOUNTS, 'brand': BRANDS, 'category': CATEGORIES, 'rep': REPS}
+DIMENSION_DTYPES = {col: pd.CategoricalDtype(sorted(vocab)) for col, vocab in DIMENSIONS.items()}
+METRIC_DTYPES = {'goal': 'int32', 'sales_volume': 'int32', 'displays': 'int16', 'pods': 'int16', 'voids': 'int16'}
+
+def to_category(s, dtype):
+    # Unordered CategoricalDtype equality ignores category order, so compare the categories themselves.
+    if isinstance(s.dtype, pd.CategoricalDtype) and s.cat.categories.equals(dtype.categories):
+        return s
+    # Strip and map the (few) distinct values once, then broadcast through the codes.
+    cat = s.astype('category')
+    lookup = pd.Categorical(cat.cat.categories.astype(str).str.strip(), dtype=dtype).codes
+    codes = np.append(lookup, -1)[cat.cat.codes.to_numpy()]
+    return pd.Series(pd.Categorical.from_codes(codes, dtype=dtype), index=s.index, name=s.name)
+
+def apply_schema(df, metrics=True):
+    for col, dtype in DIMENSION_DTYPES.items():
+        if col in df:
+            df[col] = to_category(df[col], dtype)
+    for col, dtype in (METRIC_DTYPES.items() if metrics else ()):
+        if col in df and df[col].dtype != dtype:
+            df[col] = df[col].astype(dtype)
+    return df
+
+def read_typed_csv(path, parse_dates=(), aggregated=False, chunksize=250_000, **kwargs):
+    # Aggregated tables reuse the metric names for sums, so they only get the dimension dtypes.
+    # Chunked so object strings never exist for the whole file at once; dates are converted
+    # after parsing because read_csv(parse_dates=..., dtype=...) falls back to a slow path.
+    frames = []
+    for chunk in pd.read_csv(path, dtype=None if aggregated else METRIC_DTYPES, float_precision='round_trip', chunksize=chunksize, **kwargs):
+        for col in parse_dates:
+            chunk[col] = pd.to_datetime(chunk[col])
+        frames.append(apply_schema(chunk, metrics=not aggregated))
+    if not frames:
+        return pd.read_csv(path, nrows=0, **kwargs)
+    return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+def file_checksum(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def read_json(path, default=None):
+    if not os.path.exists(path):
+        return default
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+def write_json(path, data):
+    # Written under a temporary name and renamed, so a reader never sees a half-written file.
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
 def ensure_dirs():
-    for d in [DATA_DIR, RAW_DIR, PROCESSED_DIR, OUTPUTS_DIR, DOCS_DIR, RECAPS_DIR]:
+    for d in [DATA_DIR, RAW_DIR, RAW_STORE_DIR, SPOOL_DIR, PROCESSED_DIR, OUTPUTS_DIR, QUARANTINE_DIR, DOCS_DIR, RECAPS_DIR]:
         os.makedirs(d, exist_ok=True)
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Exclusive lock (flock on LOCK_PATH) held by everything that reads, modifies and writes the raw store
+# manifest and key index or the processed outputs: generation, ingest, processing and compaction. It is
+# re-entrant within a process, so a caller holding it can run a stage that takes it again.
+_store_lock = threading.RLock()
+_store_lock_state = {'depth': 0, 'file': None}
+
+@contextmanager
+def store_lock():
+    with _store_lock:
+        if _store_lock_state['depth'] == 0:
+            os.makedirs(DATA_DIR, exist_ok=True)
+            f = open(LOCK_PATH, 'a')
+            if fcntl:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            _store_lock_state['file'] = f
+        _store_lock_state['depth'] += 1
+        try:
+            yield
+        finally:
+            _store_lock_state['depth'] -= 1
+            if _store_lock_state['depth'] == 0:
+                # Closing the file releases the flock.
+                _store_lock_state['file'].close()
+                _store_lock_state['file'] = None
+
+# Step instrumentation. Every named step appends one JSON record (duration, rows in/out, bytes read/written,
+# process peak RSS) to METRICS_PATH. CPWS_METRICS=0 turns recording off, leaving step() a no-op;
+# CPWS_PROFILE=<dir> additionally writes a cProfile dump for each outermost step.
+METRICS_ENABLED = os.environ.get('CPWS_METRICS', '1') != '0'
+PROFILE_DIR = os.environ.get('CPWS_PROFILE')
+RUN_ID = f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{os.getpid()}"
+_local = threading.local()
+_write_lock = threading.Lock()
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def peak_rss_mb():
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None
+
+def file_size(path):
+    return os.path.getsize(path) if path and os.path.exists(path) else 0
+
+class Step:
+    def __init__(self, name, fields):
+        self.name, self.fields = name, fields
+        self.rows_in = self.rows_out = None
+        self.bytes_read = self.bytes_written = 0
+
+    def read(self, *paths):
+        self.bytes_read += sum(file_size(p) for p in paths)
+
+    def wrote(self, *paths):
+        self.bytes_written += sum(file_size(p) for p in paths)
+
+class NullStep:
+    rows_in = rows_out = None
+    bytes_read = bytes_written = 0
+
+    @property
+    def fields(self):
+        return {}
+
+    def __setattr__(self, name, value):
+        pass
+
+    def read(self, *paths):
+        pass
+
+    def wrote(self, *paths):
+        pass
+
+NULL_STEP = NullStep()
+
+@contextmanager
+def step(name, **fields):
+    if not METRICS_ENABLED and not PROFILE_DIR:
+        yield NULL_STEP
+        return
+    s = Step(name, fields)
+    depth = getattr(_local, 'depth', 0)
+    profiler = cProfile.Profile() if PROFILE_DIR and depth == 0 else None
+    _local.depth = depth + 1
+    started, t0, error = datetime.now(timezone.utc), time.perf_counter(), None
+    if profiler:
+        profiler.enable()
+    try:
+        yield s
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        if profiler:
+            profiler.disable()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, f'{RUN_ID}-{name}.prof'))
+        _local.depth = depth
+        if METRICS_ENABLED:
+            record = {'run': RUN_ID, 'step': name, 'depth': depth, 'started': started.isoformat(timespec='milliseconds'),
+                      'seconds': round(time.perf_counter() - t0, 6), 'rows_in': s.rows_in, 'rows_out': s.rows_out,
+                      'bytes_read': s.bytes_read, 'bytes_written': s.bytes_written, 'peak_rss_mb': peak_rss_mb(), **s.fields}
+            if error:
+                record['error'] = error
+            write_metric(record)
+
+def write_metric(record):
+    with _write_lock:
+        os.makedirs(os.path.dirname(METRICS_PATH), exist_ok=True)
+        with open(METRICS_PATH, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, default=str) + '\n')
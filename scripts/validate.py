@@ -0,0 +1,114 @@
+import os
+import itertools
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from utils import QUARANTINE_DIR, RAW_COLUMNS, KEY_COLUMNS, DIMENSIONS, DIMENSION_DTYPES, METRIC_DTYPES, RUN_ID, to_category, step
+
+# Raw rows are checked here on their way into the store, one whole column at a time: every raw column is
+# present, dates parse, dimension values are in the fixed vocabularies, metrics are whole numbers from 0 to
+# the maximum of their stored dtype, and no key repeats within a source (all but the last occurrence fail,
+# matching the row upsert keeps). Failing rows are written with their reason codes to a zstd Parquet file
+# under QUARANTINE_DIR, one per run and batch; the rest come back in the raw store's schema. A file that
+# cannot be parsed at all is quarantined as a single 'unreadable' row carrying only its source.
+QUARANTINE_COLUMNS = ['source','reason'] + RAW_COLUMNS
+UNREADABLE = 'unreadable'
+_batches = itertools.count()
+
+def read_drop(path):
+    # Metric dtypes are not forced, so a malformed value gets quarantined instead of failing the read. None
+    # when the file is not parseable CSV (empty, broken quoting, not text).
+    try:
+        return pd.read_csv(path, dtype={col: 'category' for col in DIMENSIONS})
+    except (pd.errors.EmptyDataError, pd.errors.ParserError, UnicodeDecodeError):
+        return None
+
+def check(df):
+    # Returns (passing rows normalized to the raw schema, failing rows with a 'reason' column, count per reason).
+    df = df.reset_index(drop=True)
+    checks, clean = {}, {}
+    for col in RAW_COLUMNS:
+        if col not in df:
+            checks[f'missing_{col}'] = np.ones(len(df), dtype=bool)
+        elif col == 'date':
+            clean[col] = pd.to_datetime(df[col], errors='coerce', format='ISO8601')
+            checks['invalid_date'] = clean[col].isna().to_numpy()
+        elif col in DIMENSION_DTYPES:
+            clean[col] = to_category(df[col], DIMENSION_DTYPES[col])
+            checks[f'unknown_{col}'] = clean[col].cat.codes.to_numpy() < 0
+        else:
+            # NaN and fractions fail v == round(v); infinities pass it and fail the range check.
+            v = pd.to_numeric(df[col], errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+            invalid = ~(v == np.round(v))
+            checks[f'invalid_{col}'] = invalid
+            checks[f'range_{col}'] = ~invalid & ((v < 0) | (v > np.iinfo(METRIC_DTYPES[col]).max))
+            clean[col] = v
+    valid = ~np.logical_or.reduce(list(checks.values()))
+    duplicate = np.zeros(len(df), dtype=bool)
+    if valid.any():
+        duplicate[valid] = pd.DataFrame({col: clean[col] for col in KEY_COLUMNS})[valid].duplicated(keep='last').to_numpy()
+    checks['duplicate_key'] = duplicate
+
+    # Each failing row's reasons as a bit mask, so the ';'-joined codes are built once per distinct combination.
+    names = list(checks)
+    bits = np.zeros(len(df), dtype='int64')
+    for i, n in enumerate(names):
+        bits |= checks[n].astype('int64') << i
+    failed = bits != 0
+    combos, inverse = np.unique(bits[failed], return_inverse=True)
+    labels = np.array([';'.join(n for i, n in enumerate(names) if c >> i & 1) for c in combos], dtype=object)
+    rejected = df.loc[failed, [c for c in RAW_COLUMNS if c in df]].reset_index(drop=True)
+    rejected.insert(0, 'reason', labels[inverse])
+
+    passed = pd.DataFrame(clean)[~failed].reset_index(drop=True) if len(clean) == len(RAW_COLUMNS) else pd.DataFrame(columns=RAW_COLUMNS)
+    for col, dtype in METRIC_DTYPES.items():
+        passed[col] = passed[col].astype(dtype)
+    counts = {n: int(m.sum()) for n, m in checks.items() if m.any()}
+    return passed, rejected, counts
+
+def quarantine(rejected):
+    # Every column is stored as text as it arrived (cast in Arrow), since a bad column may hold numbers in one
+    # source and strings in another.
+    os.makedirs(QUARANTINE_DIR, exist_ok=True)
+    path = os.path.join(QUARANTINE_DIR, f'{RUN_ID}-{next(_batches):04d}.parquet')
+    parts = []
+    for df in rejected:
+        t = pa.Table.from_pandas(df, preserve_index=False)
+        parts.append(pa.table({c: t[c].cast(pa.string()) if c in t.column_names else pa.nulls(len(t), pa.string()) for c in QUARANTINE_COLUMNS}))
+    pq.write_table(pa.concat_tables(parts), path + '.tmp', compression='zstd')
+    os.replace(path + '.tmp', path)
+    return path
+
+def run(frames):
+    # frames maps a source (e.g. a drop file path) to its raw rows, or None when it could not be read.
+    # Returns the passing rows of every source and the run's quality summary, which is also recorded on the
+    # 'raw.validate' step.
+    with step('raw.validate', sources=len(frames)) as s:
+        passed, rejected, reasons = [], [], {}
+        for source, df in frames.items():
+            if df is None:
+                rejected.append(pd.DataFrame({'source': [source], 'reason': [UNREADABLE]}))
+                reasons[UNREADABLE] = reasons.get(UNREADABLE, 0) + 1
+                continue
+            ok, bad, counts = check(df)
+            passed.append(ok)
+            if len(bad):
+                rejected.append(bad.assign(source=source))
+            for reason, n in counts.items():
+                reasons[reason] = reasons.get(reason, 0) + n
+        passed = [p for p in passed if len(p)] or passed[:1] or [check(pd.DataFrame(columns=RAW_COLUMNS))[0]]
+        df = pd.concat(passed, ignore_index=True) if len(passed) > 1 else passed[0]
+        path = quarantine(rejected) if rejected else None
+        rows = sum(len(f) for f in frames.values() if f is not None)
+        summary = {'rows': rows, 'passed': len(df), 'quarantined': rows - len(df), 'reasons': reasons, 'quarantine': path}
+        s.rows_in, s.rows_out = rows, len(df)
+        s.fields.update(quarantined=summary['quarantined'], reasons=reasons)
+        s.wrote(path)
+    return df, summary
+
+def describe(summary):
+    text = f"validated {summary['rows']:,} row(s): {summary['passed']:,} passed, {summary['quarantined']:,} quarantined"
+    if summary['quarantine']:
+        text += ' (' + ', '.join(f'{r} {n:,}' for r, n in sorted(summary['reasons'].items())) + f") -> {summary['quarantine']}"
+    return text
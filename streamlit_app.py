@@ -1,58 +1,152 @@
 
 import os
+import sys
 import pandas as pd
 import numpy as np
 import streamlit as st
 import plotly.express as px
 
-DATA_DIR = 'data'
-PROCESSED = os.path.join(DATA_DIR, 'processed', 'processed.csv')
-TERR = os.path.join(DATA_DIR, 'outputs', 'territory_summary.csv')
-ACC = os.path.join(DATA_DIR, 'outputs', 'account_summary.csv')
-REP = os.path.join(DATA_DIR, 'outputs', 'rep_scorecards.csv')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scripts'))
+# Every widget interaction reruns the script, so step metrics are off here unless CPWS_METRICS=1 is set.
+os.environ.setdefault('CPWS_METRICS', '0')
+import tables
+import periods
+import sqlite_store
+import features
+from periods import PERIOD
+
+PROCESSED = tables.PROCESSED
+TERR = tables.output('territory_summary')
+ACC = tables.output('account_summary')
+REP = tables.output('rep_scorecards')
+FEATURES = tables.output(features.NAME)
+PROCESSED_COLUMNS = ['date',PERIOD,'market','account','goal','sales_volume']
 RECAPS_DIR = os.path.join('docs', 'weekly_recaps')
 
 st.set_page_config(page_title='CPWS Roll-Up (Simulated)', layout='wide')
 st.title('CPWS Roll-Up Dashboard (Interactive, Simulated Data)')
 st.caption('Auto-updating pipeline with simulated CPWS-style data. Not real customer data.')
 
+def load_daily(stem):
+    # The app only ever needs daily totals per market/account, so collapse the processed rows once per version
+    # and index the row positions of every period, market and account.
+    df = tables.read_table(stem, columns=PROCESSED_COLUMNS)
+    daily = df.groupby([PERIOD,'date','market','account'], observed=True)[['goal','sales_volume']].sum().reset_index()
+    week_rows = daily.groupby(PERIOD).indices
+    market_rows = daily.groupby('market', observed=True).indices
+    account_rows = daily.groupby('account', observed=True).indices
+    return daily, week_rows, market_rows, account_rows
+
+def load_rollup(stem):
+    return tables.read_table(stem, aggregated=True)
+
+@st.cache_resource(show_spinner=False)
+def data_handle():
+    # Shared by every session in the process (not copied per session); refreshed on each rerun.
+    return tables.TableCache({'daily': (PROCESSED, load_daily), 'territory_summary': (TERR, load_rollup), 'account_summary': (ACC, load_rollup), 'rep_scorecards': (REP, load_rollup), features.NAME: (FEATURES, load_rollup)})
+
+def rows_for(groups, keys, n):
+    mask = np.zeros(n, dtype=bool)
+    for k in keys:
+        if k in groups:
+            mask[groups[k]] = True
+    return mask
+
+# When process_data.py ran with --sqlite the app queries the indexed SQLite store for just the rows each
+# widget and chart needs, and never loads whole tables into the process; otherwise it uses the shared
+# in-memory frames above.
+USE_SQLITE = sqlite_store.exists()
+
+def sqlite_rows(table, columns='*', week=None, markets=None, accounts=None, tail=''):
+    clause, params = sqlite_store.where(week, market=markets, account=accounts)
+    return sqlite_store.query(f'SELECT {columns} FROM "{table}"{clause}{tail}', params, aggregated=table != 'processed')
+
 @st.cache_data(show_spinner=False)
-def load_data():
-    if not (os.path.exists(PROCESSED) and os.path.exists(TERR) and os.path.exists(ACC)):
-        st.error('Processed outputs not found. Run the pipeline first.')
-        st.stop()
-    df = pd.read_csv(PROCESSED, parse_dates=['date'])
-    terr = pd.read_csv(TERR)
-    acc = pd.read_csv(ACC)
-    rep = pd.read_csv(REP) if os.path.exists(REP) else pd.DataFrame()
-    return df, terr, acc, rep
+def sqlite_options(version):
+    present = sqlite_store.table_names()
+    return ([int(k) for k in sqlite_store.distinct('territory_summary', PERIOD)], sqlite_store.distinct(sqlite_store.DAILY, 'market'),
+            sqlite_store.distinct(sqlite_store.DAILY, 'account'), 'rep_scorecards' in present)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def selection_rows(version, markets, accounts):
+    daily, _, market_rows, account_rows = data_handle()['daily']
+    mask = rows_for(market_rows, markets, len(daily))
+    if accounts:
+        mask &= rows_for(account_rows, accounts, len(daily))
+    return np.flatnonzero(mask)
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def week_totals(version, week, markets, accounts):
+    if USE_SQLITE:
+        totals = sqlite_rows(sqlite_store.DAILY, 'COALESCE(SUM(goal), 0) AS goal, COALESCE(SUM(sales_volume), 0) AS sales_volume', week, markets, accounts or None)
+        return int(totals['goal'].iloc[0]), int(totals['sales_volume'].iloc[0])
+    daily, week_rows, _, _ = data_handle()['daily']
+    rows = np.intersect1d(selection_rows(version, markets, accounts), week_rows.get(week, np.array([], dtype=int)), assume_unique=True)
+    return int(daily['goal'].to_numpy()[rows].sum()), int(daily['sales_volume'].to_numpy()[rows].sum())
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def feature_totals(version, week, markets, accounts):
+    # WoW change and 4-week / year-to-date attainment for the selection, summed from the feature table.
+    cols = ['wow_change','sales_4w','goal_4w','sales_ytd','goal_ytd']
+    if USE_SQLITE:
+        return sqlite_rows(features.NAME, ', '.join(f'COALESCE(SUM({c}), 0) AS {c}' for c in cols), week, markets, accounts or None).iloc[0].astype(int).to_dict()
+    df = periods.rows(data_handle()[features.NAME], week)
+    df = df[df['market'].isin(markets) & (df['account'].isin(accounts) if accounts else True)]
+    return {c: int(df[c].sum()) for c in cols}
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def daily_trend(version, markets, accounts):
+    if USE_SQLITE:
+        return sqlite_rows(sqlite_store.DAILY, 'date, market, SUM(sales_volume) AS sales_volume', None, markets, accounts or None, ' GROUP BY date, market ORDER BY date, market')
+    daily = data_handle()['daily'][0]
+    return daily.iloc[selection_rows(version, markets, accounts)].groupby(['date','market'], observed=True)['sales_volume'].sum().reset_index()
 
 @st.cache_data(show_spinner=False)
-def latest_recaps(n=5):
+def latest_recaps(dir_mtime, n=5):
     if not os.path.isdir(RECAPS_DIR):
         return []
     pdfs = [f for f in os.listdir(RECAPS_DIR) if f.endswith('.pdf')]
     pdfs.sort(reverse=True)
     return pdfs[:n]
 
-df, terr, acc, rep = load_data()
+@st.cache_data(show_spinner=False, max_entries=64)
+def week_rollup(version, name, week, markets):
+    if USE_SQLITE:
+        return sqlite_rows(name, '*', week, markets)
+    df = periods.rows(data_handle()[name], week)
+    return df[df['market'].isin(markets)]
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def rep_rows(version, markets, accounts):
+    if USE_SQLITE:
+        return sqlite_rows('rep_scorecards', '*', None, markets, accounts or None)
+    rep = data_handle()['rep_scorecards']
+    rep_f = rep[rep['market'].isin(markets)]
+    return rep_f[rep_f['account'].isin(accounts)] if accounts else rep_f
+
+if USE_SQLITE:
+    version = sqlite_store.version()
+    week_keys, markets, accounts, has_rep = sqlite_options(version)
+else:
+    handle = data_handle()
+    handle.refresh()
+    if handle['daily'] is None or handle['territory_summary'] is None or handle['account_summary'] is None:
+        st.error('Processed outputs not found. Run the pipeline first.')
+        st.stop()
+    version = handle.version
+    daily = handle['daily'][0]
+    week_keys = periods.unique(handle['territory_summary'][PERIOD])
+    markets, accounts = sorted(daily['market'].unique()), sorted(daily['account'].unique())
+    has_rep = handle['rep_scorecards'] is not None
 
 st.sidebar.header('Filters')
-weeks = sorted(terr['week'].unique())
-sel_week = st.sidebar.selectbox('ISO Week', options=weeks, index=len(weeks)-1)
-markets = sorted(df['market'].unique())
+weeks = [periods.label(k) for k in week_keys]
+sel_week = periods.parse(st.sidebar.selectbox('ISO Week', options=weeks, index=len(weeks)-1))
 sel_markets = st.sidebar.multiselect('Markets', options=markets, default=markets)
-accounts = sorted(df['account'].unique())
 sel_accounts = st.sidebar.multiselect('Accounts', options=accounts)
+sel_key = (tuple(sorted(sel_markets)), tuple(sorted(sel_accounts)))
 
-fil_df = df[df['market'].isin(sel_markets)]
-if sel_accounts:
-    fil_df = fil_df[fil_df['account'].isin(sel_accounts)]
-
-wk_df = fil_df[fil_df['date'].dt.isocalendar().week.astype(int) == sel_week]
-
-goal = wk_df['goal'].sum()
-sales = wk_df['sales_volume'].sum()
+goal, sales = week_totals(version, int(sel_week), *sel_key)
 g2g = max(goal - sales, 0)
 pct = (sales / goal) if goal else np.nan
 
@@ -61,42 +155,71 @@ c1.metric('Total Sales (Week)', f"{int(sales):,}")
 c2.metric('Gap to Goal', f"{int(g2g):,}")
 c3.metric('% Attained', f"{pct:.0%}" if pd.notna(pct) else '—')
 
-terr_wk = terr[(terr['week']==sel_week) & (terr['market'].isin(sel_markets))].sort_values('pct_attained', ascending=False)
-fig_bar = px.bar(terr_wk, x='market', y='pct_attained', text='pct_attained', title=f'Territory % Attained — Week {sel_week}')
+feat = feature_totals(version, int(sel_week), *sel_key)
+c4, c5, c6 = st.columns(3)
+c4.metric('WoW Sales Change', f"{feat['wow_change']:+,}")
+c5.metric('4-Week % Attained', f"{feat['sales_4w'] / feat['goal_4w']:.0%}" if feat['goal_4w'] else '—')
+c6.metric('YTD % Attained', f"{feat['sales_ytd'] / feat['goal_ytd']:.0%}" if feat['goal_ytd'] else '—')
+
+terr_wk = week_rollup(version, 'territory_summary', sel_week, sel_key[0]).sort_values('pct_attained', ascending=False)
+fig_bar = px.bar(terr_wk, x='market', y='pct_attained', text='pct_attained', title=f'Territory % Attained — {periods.label(sel_week)}')
 fig_bar.update_traces(texttemplate='%{text:.0%}', textposition='outside')
 fig_bar.update_yaxes(tickformat='.0%')
 st.plotly_chart(fig_bar, use_container_width=True)
 
-trend = fil_df.groupby(['date','market'])['sales_volume'].sum().reset_index()
+trend = daily_trend(version, *sel_key)
 fig_line = px.line(trend, x='date', y='sales_volume', color='market', title='Daily Sales Volume Trend')
 st.plotly_chart(fig_line, use_container_width=True)
 
-acc_wk = acc[(acc['week']==sel_week) & (acc['market'].isin(sel_markets))].copy()
+acc_wk = week_rollup(version, 'account_summary', sel_week, sel_key[0]).copy()
 acc_wk['disp_per_1k_goal'] = (acc_wk['displays'] / acc_wk['goal'].replace(0,1)) * 1000
 fig_heat = px.density_heatmap(acc_wk, x='account', y='market', z='disp_per_1k_goal', color_continuous_scale='Blues', title='Display Intensity (per 1,000 Goal)')
 st.plotly_chart(fig_heat, use_container_width=True)
 
 with st.expander('Rep Scorecards (filtered)'):
-    if rep.empty:
+    if not has_rep:
         st.info('No rep scorecards yet.')
     else:
-        rep_f = rep[rep['market'].isin(sel_markets)]
-        if sel_accounts:
-            rep_f = rep_f[rep_f['account'].isin(sel_accounts)]
-        rep_f = rep_f.sort_values('pct_attained', ascending=False)
+        rep_f = rep_rows(version, *sel_key).sort_values('pct_attained', ascending=False)
         st.dataframe(rep_f, use_container_width=True)
 
-with st.expander('Download Data'):
-    st.download_button('Processed CSV', data=df.to_csv(index=False), file_name='processed.csv')
-    st.download_button('Territory Summary CSV', data=terr.to_csv(index=False), file_name='territory_summary.csv')
-    st.download_button('Account Summary CSV', data=acc.to_csv(index=False), file_name='account_summary.csv')
-    if not rep.empty:
-        st.download_button('Rep Scorecards CSV', data=rep.to_csv(index=False), file_name='rep_scorecards.csv')
+EXPORTS = {'Processed rows': 'processed', 'Filtered rows (selected week, markets, accounts)': 'filtered', 'Territory Summary': 'territory_summary', 'Account Summary': 'account_summary', 'Rep Scorecards': 'rep_scorecards'}
+
+@st.cache_data(show_spinner='Preparing export...', max_entries=4, ttl=300)
+def export_data(version, dataset, fmt, week=None, markets=(), accounts=()):
+    # Serialized only when asked for and cached per data version; nothing is rendered to bytes on normal reruns.
+    # A whole-table export can run to hundreds of MB, so only a few are kept, and only for a few minutes.
+    if USE_SQLITE and dataset == 'processed':
+        df = sqlite_rows('processed', tail=' ORDER BY date, rowid')
+    elif USE_SQLITE and dataset == 'filtered':
+        df = sqlite_rows('processed', '*', week, markets, accounts or None, ' ORDER BY date, rowid')
+    elif USE_SQLITE:
+        df = sqlite_rows(dataset)
+    elif dataset == 'processed':
+        df = tables.read_table(PROCESSED)
+    elif dataset == 'filtered':
+        df = periods.rows(tables.read_table(PROCESSED), week)
+        df = df[df['market'].isin(markets) & (df['account'].isin(accounts) if accounts else True)]
+    else:
+        df = tables.read_table(tables.output(dataset), aggregated=True)
+    return tables.export_bytes(df, fmt)
 
-recaps = latest_recaps(5)
+with st.expander('Download Data'):
+    d1, d2 = st.columns(2)
+    label = d1.selectbox('Dataset', options=[k for k, v in EXPORTS.items() if v != 'rep_scorecards' or has_rep])
+    fmt = d2.selectbox('Format', options=list(tables.EXPORT_FORMATS))
+    dataset = EXPORTS[label]
+    export_key = (version, dataset, fmt) + ((int(sel_week),) + sel_key if dataset == 'filtered' else ())
+    if st.button('Prepare download'):
+        st.session_state['export_key'] = export_key
+    if st.session_state.get('export_key') == export_key:
+        ext, mime = tables.EXPORT_FORMATS[fmt]
+        st.download_button(f'Download {label}', data=export_data(*export_key), file_name=f'{dataset}{ext}', mime=mime)
+
+recaps = latest_recaps(os.stat(RECAPS_DIR).st_mtime_ns if os.path.isdir(RECAPS_DIR) else 0, 5)
 if recaps:
     st.subheader('Latest Weekly Recaps (PDF)')
     for r in recaps:
         st.markdown(f'- [{r}](docs/weekly_recaps/{r})')
 
-st.caption('© 2026 Jesse Flippen · Simulated data for demonstration only.')
+st.caption(f'Data version {version} · © 2026 Jesse Flippen · Simulated data for demonstration only.')
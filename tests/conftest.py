@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The scripts import each other as top-level modules and resolve data/ relative to the working directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+os.environ.setdefault('CPWS_METRICS', '0')
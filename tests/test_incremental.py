@@ -0,0 +1,84 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import compact
+import features
+import generate_fake_data
+import process_data
+import raw_store
+import rollups
+import tables
+from periods import PERIOD
+
+# Every case builds a raw store in its own temporary directory, processes it after each change with the
+# options under test and compares the outputs with a plain full rebuild of the same store. Days are kept
+# small so the suite stays quick.
+ROWS_PER_DAY = 120
+OPTIONS = {'serial': [], 'chunked': ['--chunk-rows', '700'], 'workers': ['--workers', '2']}
+
+@pytest.fixture(params=list(OPTIONS))
+def opts(request, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return OPTIONS[request.param]
+
+def generate(start, days, rows=ROWS_PER_DAY, seed=42, force=False):
+    generate_fake_data.main(['--days', str(days), '--start', start, '--rows-per-day', str(rows), '--seed', str(seed)] + (['--force'] if force else []))
+
+def outputs():
+    found = {tables.PROCESSED: tables.read_table(tables.PROCESSED), tables.CUBE: tables.read_table(tables.CUBE, aggregated=True)}
+    for name in list(rollups.ROLLUPS) + [features.NAME]:
+        found[name] = tables.read_table(tables.output(name), aggregated=True)
+    return found
+
+def check(opts):
+    # The run under test (incremental once outputs exist), then a full rebuild to compare it with.
+    process_data.main(opts)
+    processed = outputs()
+    process_data.main(['--full'])
+    for name, df in outputs().items():
+        pd.testing.assert_frame_equal(processed[name], df, obj=name)
+    manifest = raw_store.load_manifest()
+    assert os.path.exists(raw_store.KEY_INDEX_PATH) and manifest['key_index_rows'] == raw_store.total_rows(manifest)
+    np.testing.assert_array_equal(raw_store.load_key_index(manifest), raw_store.build_key_index(manifest))
+    return processed
+
+def test_append(opts):
+    generate('2026-01-05', 10)
+    check(opts)
+    generate('2026-01-15', 4)
+    check(opts)
+
+def test_backfill(opts):
+    generate('2026-02-02', 10)
+    check(opts)
+    generate('2026-01-20', 5)
+    check(opts)
+
+def test_force_replace(opts):
+    generate('2026-01-05', 14)
+    check(opts)
+    generate('2026-01-08', 2, rows=40, seed=7, force=True)
+    check(opts)
+
+def test_iso_year_boundary(opts):
+    # 2026 has 53 ISO weeks: 2026-12-28 .. 2027-01-03 is 2026-W53 and 2027-W01 starts on 2027-01-04.
+    generate('2026-12-21', 10)
+    check(opts)
+    generate('2026-12-31', 8)
+    check(opts)
+    generate('2027-01-02', 3, rows=50, seed=3, force=True)
+    processed = check(opts)
+    assert {202652, 202653, 202701} <= set(processed[tables.PROCESSED][PERIOD].unique().tolist())
+
+def test_compaction_then_late_upsert(opts):
+    generate('2026-01-01', 45)
+    check(opts)
+    compact.main(['--grace-days', '3', '--keep-days', '-1'])
+    assert 'month=2026-01' in raw_store.load_manifest()['partitions']
+    check(opts)
+    # A replaced day and merged late rows, both landing in the compacted month.
+    generate('2026-01-20', 2, rows=60, seed=5, force=True)
+    check(opts)
+    generate('2026-01-25', 2, seed=9)
+    check(opts)